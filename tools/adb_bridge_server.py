@@ -4,125 +4,186 @@ ADB Bridge Server - runs on comma device
 Receives joystick commands via TCP and publishes to testJoystick
 Low-latency bridge for teledriving via ADB
 """
+import os
 import sys
 import time
-import json
+import struct
 import socket
-import threading
-import select
+import selectors
 
 # Import comma device modules
 from cereal import messaging
 from openpilot.common.params import Params
 from openpilot.common.realtime import Ratekeeper
+from openpilot.tools.adb_protocol import (MSG_JOYSTICK, MSG_PING, MSG_PONG, MSG_ERROR, JOYSTICK, PING, PONG, ERROR, LENGTH,
+                                          MAX_PAYLOAD, set_low_latency, rearm_quickack)
 
 
-# Global message publisher
+# Print joystick status from the hot path, off by default since the bridge runs under manager
+DEBUG = bool(os.environ.get('ADB_BRIDGE_DEBUG'))
+
+# Global message publisher, the reused testJoystick message and the prebuilt neutral one
 pm = None
-last_joy_time = 0
+joystick_msg = None
+joystick_axes = None
+neutral_msg = None
+msg_count = 0
+
+JOYSTICK_TIMEOUT_NS = 500_000_000
+WATCHDOG_INTERVAL = 0.05  # selector wakeup period for the joystick timeout check
+last_joy_time_ns = 0
+
+def send_error(conn, error, seq=0):
+    conn.send_frame(ERROR.pack(MSG_ERROR, time.monotonic_ns(), seq) + error.encode())
+
+
+def handle_joystick(conn, fields, recv_time_ns):
+    """Joystick command - publish to testJoystick"""
+    global last_joy_time_ns, msg_count
+    _, gb, steer, logging_enabled, _, _ = fields
+
+    # Update the axes in place so the reused message does not grow
+    joystick_msg.logMonoTime = recv_time_ns
+    joystick_axes[0] = gb
+    joystick_axes[1] = steer
+    joystick_msg.testJoystick.loggingEnabled = logging_enabled
+    pm.send('testJoystick', joystick_msg)
+
+    last_joy_time_ns = recv_time_ns
+
+    # Debug: print every 20 messages (at 100Hz = 5Hz output)
+    if DEBUG:
+        msg_count += 1
+        if msg_count % 20 == 0:
+            log_status = "[LOG]" if logging_enabled else ""
+            print(f'\rJoystick: gb={gb:+.3f}, steer={steer:+.3f} {log_status}', end='', flush=True)
+
+    # No ack needed for joystick - running at 100Hz
 
-def handle_client_socket(client_sock, client_addr):
-    """Handle a single client connection"""
-    global last_joy_time
-    print(f"Client connected: {client_addr}", file=sys.stderr, flush=True)
-    client_file = client_sock.makefile('rw', buffering=1)
 
+def handle_ping(conn, fields, recv_time_ns):
+    """Ping for latency measurement"""
+    _, client_time_ns, seq = fields
+    conn.send_frame(PONG.pack(MSG_PONG, client_time_ns, recv_time_ns, time.monotonic_ns(), seq))
+
+
+# Message type -> (decoder, handler)
+FRAME_HANDLERS = {
+    MSG_JOYSTICK: (JOYSTICK.unpack, handle_joystick),
+    MSG_PING: (PING.unpack, handle_ping),
+}
+
+
+def handle_frame(conn, payload, recv_time_ns):
+    """Decode a single frame payload and dispatch it on its message type"""
+    entry = FRAME_HANDLERS.get(payload[0])
+    if entry is None:
+        send_error(conn, f'Unknown command type: {payload[0]}')
+        return
+
+    decode, handler = entry
     try:
-        while True:
-            # Read command from client
-            line = client_file.readline()
-            if not line:
+        fields = decode(payload)
+    except struct.error as e:
+        send_error(conn, f'Frame decode error: {str(e)}')
+        return
+    handler(conn, fields, recv_time_ns)
+
+
+class ClientConnection:
+    """Read and reply state for one non-blocking client socket driven by the selector loop"""
+
+    def __init__(self, sock, addr, sel):
+        self.sock = sock
+        self.addr = addr
+        self.sel = sel
+        self.buf = bytearray(4 + MAX_PAYLOAD)
+        self.view = memoryview(self.buf)
+        self.end = 0
+        # Reply bytes the socket didn't take yet, flushed in order on EVENT_WRITE
+        self.out = bytearray()
+
+    def send_frame(self, payload):
+        """Write a single length-prefixed frame, queueing whatever doesn't fit in the socket buffer"""
+        frame = LENGTH.pack(len(payload)) + payload
+        if self.out:
+            # Never write past a queued partial reply, the stream would be corrupt otherwise
+            self.out += frame
+            return
+        try:
+            n = self.sock.send(frame)
+        except BlockingIOError:
+            n = 0
+        if n < len(frame):
+            self.out += frame[n:]
+            self.sel.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    def on_writable(self):
+        """Flush queued replies, stops watching for EVENT_WRITE once they're all out"""
+        try:
+            n = self.sock.send(self.out)
+        except BlockingIOError:
+            return
+        del self.out[:n]
+        if not self.out:
+            self.sel.modify(self.sock, selectors.EVENT_READ, self)
+
+    def on_readable(self):
+        """Read what is available and handle every complete frame, returns False once the client is gone"""
+        sock = self.sock
+        buf = self.buf
+        view = self.view
+        end = self.end
+
+        try:
+            n = sock.recv_into(view[end:])
+        except BlockingIOError:
+            return True
+        if n == 0:
+            return False
+        rearm_quickack(sock)
+        end += n
+        # Account for the new bytes before dispatching, so a failing handler can't make the next read overwrite them
+        self.end = end
+        recv_time_ns = time.monotonic_ns()
+
+        unpack_from = LENGTH.unpack_from
+        dispatch = handle_frame
+        start = 0
+        while end - start >= 4:
+            length = unpack_from(buf, start)[0]
+            if length == 0 or length > MAX_PAYLOAD:
+                send_error(self, f'Invalid frame length: {length}')
+                return False
+            if end - start - 4 < length:
                 break
+            dispatch(self, view[start + 4:start + 4 + length], recv_time_ns)
+            start += 4 + length
 
-            line = line.strip()
-            if not line:
-                continue
-
-            recv_time = time.time()
-
-            try:
-                # Parse command
-                cmd = json.loads(line)
-                cmd_type = cmd.get('type', 'unknown')
-
-                if cmd_type == 'joystick':
-                    # Joystick command - publish to testJoystick
-                    axes = cmd.get('axes', [0.0, 0.0])
-                    logging_enabled = cmd.get('loggingEnabled', False)
-
-                    # Create and send testJoystick message
-                    joystick_msg = messaging.new_message('testJoystick')
-                    joystick_msg.valid = True
-                    joystick_msg.testJoystick.axes = axes
-                    joystick_msg.testJoystick.loggingEnabled = logging_enabled
-                    pm.send('testJoystick', joystick_msg)
-
-                    last_joy_time = recv_time
-
-                    # Debug: print every 20 messages (at 100Hz = 5Hz output)
-                    global msg_count
-                    msg_count = globals().get('msg_count', 0) + 1
-                    if msg_count % 20 == 0:
-                        log_status = "[LOG]" if logging_enabled else ""
-                        print(f'\rJoystick: gb={axes[0]:+.3f}, steer={axes[1]:+.3f} {log_status}', end='', flush=True)
-
-                    # No ack needed for joystick - running at 100Hz
-
-                elif cmd_type == 'ping':
-                    # Ping for latency measurement
-                    response = {
-                        'type': 'pong',
-                        'client_time': cmd.get('time', 0),
-                        'server_recv_time': recv_time,
-                        'server_send_time': time.time(),
-                        'seq': cmd.get('seq', 0)
-                    }
-                    client_file.write(json.dumps(response) + '\n')
-                    client_file.flush()
-
-                else:
-                    # Unknown command
-                    response = {
-                        'type': 'error',
-                        'error': f'Unknown command type: {cmd_type}',
-                        'server_time': time.time(),
-                        'seq': cmd.get('seq', 0)
-                    }
-                    client_file.write(json.dumps(response) + '\n')
-                    client_file.flush()
-
-            except json.JSONDecodeError as e:
-                error_response = {
-                    'type': 'error',
-                    'error': f'JSON decode error: {str(e)}',
-                    'server_time': time.time()
-                }
-                client_file.write(json.dumps(error_response) + '\n')
-                client_file.flush()
-
-    except Exception as e:
-        print(f"Client handler error: {e}", file=sys.stderr, flush=True)
-    finally:
-        client_sock.close()
-        print(f"Client disconnected: {client_addr}", file=sys.stderr, flush=True)
-
-
-def watchdog_thread():
-    """Monitor for joystick timeout and reset to neutral"""
-    global last_joy_time
-    while True:
-        time.sleep(0.1)
-        if last_joy_time > 0 and (time.time() - last_joy_time) > 0.5:
-            # No joystick data for 500ms - send neutral position
-            joystick_msg = messaging.new_message('testJoystick')
-            joystick_msg.valid = True
-            joystick_msg.testJoystick.axes = [0.0, 0.0]
-            joystick_msg.testJoystick.loggingEnabled = False
-            pm.send('testJoystick', joystick_msg)
-            last_joy_time = 0  # Reset to avoid spamming
+        # Keep any partial frame at the start of the buffer
+        if start:
+            buf[:end - start] = buf[start:end]
+            end -= start
+        self.end = end
+        return True
+
+    def close(self):
+        self.sock.close()
+        print(f"Client disconnected: {self.addr}", file=sys.stderr, flush=True)
+
+
+def check_joystick_timeout():
+    """Reset to neutral if joystick data stopped arriving"""
+    global last_joy_time_ns
+    now_ns = time.monotonic_ns()
+    if last_joy_time_ns and now_ns - last_joy_time_ns > JOYSTICK_TIMEOUT_NS:
+        # No joystick data for 500ms - send neutral position
+        neutral_msg.logMonoTime = now_ns
+        pm.send('testJoystick', neutral_msg)
+        last_joy_time_ns = 0  # Reset to avoid spamming
 
 def main():
-    global pm
+    global pm, joystick_msg, joystick_axes, neutral_msg
     import argparse
     parser = argparse.ArgumentParser(description='ADB Bridge Server - Joystick Bridge')
     parser.add_argument('--port', type=int, default=5555, help='TCP port to listen on')
@@ -140,13 +201,16 @@ def main():
 
     # Initialize message publisher
     pm = messaging.PubMaster(['testJoystick'])
+    joystick_msg = messaging.new_message('testJoystick')
+    joystick_msg.valid = True
+    joystick_axes = joystick_msg.testJoystick.init('axes', 2)
+    neutral_msg = messaging.new_message('testJoystick')
+    neutral_msg.valid = True
+    neutral_msg.testJoystick.axes = [0.0, 0.0]
+    neutral_msg.testJoystick.loggingEnabled = False
 
     # Enable joystick debug mode
 
-    # Start watchdog thread
-    watchdog = threading.Thread(target=watchdog_thread, daemon=True)
-    watchdog.start()
-
     print(f"ADB Bridge Server Starting (Joystick mode on {args.host}:{args.port})", file=sys.stderr, flush=True)
 
     # Set TCP_NODELAY for low latency
@@ -159,22 +223,43 @@ def main():
     print(f"Server listening on {args.host}:{args.port}", file=sys.stderr, flush=True)
     print("Waiting for ROS joystick bridge client...", file=sys.stderr, flush=True)
 
+    server_sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(server_sock, selectors.EVENT_READ)
+
+    select = sel.select
+    check_timeout = check_joystick_timeout
+
     try:
         while True:
-            client_sock, client_addr = server_sock.accept()
-            # Set TCP_NODELAY on client socket too
-            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-            # Handle each client in a new thread
-            client_thread = threading.Thread(
-                target=handle_client_socket,
-                args=(client_sock, client_addr),
-                daemon=True
-            )
-            client_thread.start()
+            for key, events in select(timeout=WATCHDOG_INTERVAL):
+                if key.fileobj is server_sock:
+                    client_sock, client_addr = server_sock.accept()
+                    # TCP_NODELAY, small buffers and quick ACKs on the client socket
+                    set_low_latency(client_sock)
+                    client_sock.setblocking(False)
+                    print(f"Client connected: {client_addr}", file=sys.stderr, flush=True)
+                    sel.register(client_sock, selectors.EVENT_READ, ClientConnection(client_sock, client_addr, sel))
+                    continue
+
+                conn = key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        conn.on_writable()
+                    alive = conn.on_readable() if events & selectors.EVENT_READ else True
+                except Exception as e:
+                    print(f"Client handler error: {e}", file=sys.stderr, flush=True)
+                    alive = False
+
+                if not alive:
+                    sel.unregister(conn.sock)
+                    conn.close()
+
+            check_timeout()
     except KeyboardInterrupt:
         print("\nServer stopped", file=sys.stderr, flush=True)
     finally:
+        sel.close()
         server_sock.close()
 
 if __name__ == '__main__':
@@ -5,15 +5,27 @@ Reads PS4 controller input via evdev and sends to comma device via ADB
 Based on working PS4 controller evdev implementation
 """
 import socket
-import json
 import time
 import sys
 import os
 import argparse
-import numpy as np
-from evdev import InputDevice, categorize, ecodes, list_devices
+import select
+import selectors
+from evdev import InputDevice, ecodes, list_devices
+
+from openpilot.tools.adb_protocol import (MSG_JOYSTICK, MSG_PING, MSG_PONG, JOYSTICK, PING, PONG, LENGTH,
+                                          set_low_latency, rearm_quickack)
 
 EXPO = 0.4
+AXIS_MAX = 255  # evdev reports 8-bit axis values for PS4/PS5 controllers
+# Axis slots used to batch raw evdev values in Joystick.read_events
+STEER, BRAKE, GAS = range(3)
+KEEPALIVE_NS = 200_000_000  # resend unchanged axes at 5 Hz, well inside the server's 500 ms timeout
+AXIS_EPSILON = 1e-3  # smaller axis changes than this don't trigger a send
+PING_TIMEOUT = 2.0  # seconds
+SEND_PERIOD_NS = 10_000_000  # 100 Hz
+KEY_STEPS = 20  # keyboard key presses from neutral to full actuation
+SPIN_NS = 100_000  # busy-wait the last 100 us before a deadline
 
 
 class ADBJoystickClient:
@@ -33,6 +45,22 @@ class ADBJoystickClient:
         self.port = port
         self.sock = None
         self.seq = 0
+        # Frames have a fixed size, so the length header is written once and the payload packed in place
+        self._joy_frame = bytearray(LENGTH.size + JOYSTICK.size)
+        LENGTH.pack_into(self._joy_frame, 0, JOYSTICK.size)
+        self._ping_frame = bytearray(LENGTH.size + PING.size)
+        LENGTH.pack_into(self._ping_frame, 0, PING.size)
+        # Receive buffer reused for every ping reply
+        self._rxbuf = bytearray(4096)
+        self._rxview = memoryview(self._rxbuf)
+        # Last frame sent, used to skip resending unchanged axes
+        self._last_gb = 0.0
+        self._last_steer = 0.0
+        self._last_log = False
+        self._last_send_ns = 0
+        # Unsent tail of a partially written frame
+        self._pending = None
+        self._sel = None
 
     def connect(self):
         """Establish connection (and optionally set up ADB forwarding)"""
@@ -51,68 +79,99 @@ class ADBJoystickClient:
         # Connect to the server
         print(f"Connecting to {self.host}:{self.port}")
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Enable TCP_NODELAY for low latency
-        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # TCP_NODELAY, small buffers and quick ACKs, set before connect so the buffer sizes apply to the handshake
+        set_low_latency(self.sock)
         self.sock.connect((self.host, self.port))
+        # Non-blocking so a stalled link drops frames instead of stalling the send loop
+        self.sock.setblocking(False)
+        if self._sel is not None:
+            self._sel.close()
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self.sock, selectors.EVENT_READ)
+        self._pending = None
+        self._last_send_ns = 0  # always send the first frame on a new connection
         print("Connected!")
 
-    def send_joystick(self, axes, logging_enabled=False):
+    def _send_frame(self, frame):
+        """Write a complete frame with a single send(), returns False if it was dropped"""
+        # Finish a partially written frame first, the stream would be corrupt otherwise
+        if self._pending is not None:
+            try:
+                n = self.sock.send(self._pending)
+            except BlockingIOError:
+                return False
+            self._pending = self._pending[n:] or None
+            if self._pending is not None:
+                return False
+
+        # Latest wins: if the socket buffer is full the frame is dropped rather than queued
+        try:
+            n = self.sock.send(frame)
+        except BlockingIOError:
+            return False
+        if n < len(frame):
+            self._pending = bytes(frame[n:])
+        return True
+
+    def send_joystick(self, axes, logging_enabled, now_ns):
         """
         Send joystick axes to the server
 
         Args:
             axes: List of two floats [longitudinal, lateral] (gb, steer)
             logging_enabled: Boolean to enable/disable logging on device
+            now_ns: time.monotonic_ns() of the current loop iteration
         """
-        cmd = {
-            'type': 'joystick',
-            'axes': axes,
-            'loggingEnabled': logging_enabled,
-            'time': time.time(),
-            'seq': self.seq
-        }
+        gb, steer = axes
+        # Compared against the last frame sent, so slow drift still goes out once it adds up
+        if (abs(gb - self._last_gb) <= AXIS_EPSILON and abs(steer - self._last_steer) <= AXIS_EPSILON and
+                logging_enabled == self._last_log and now_ns - self._last_send_ns < KEEPALIVE_NS):
+            return
+
+        JOYSTICK.pack_into(self._joy_frame, LENGTH.size, MSG_JOYSTICK, gb, steer, logging_enabled, now_ns, self.seq)
         self.seq += 1
 
-        cmd_json = json.dumps(cmd) + '\n'
-        self.sock.sendall(cmd_json.encode())
+        # A dropped frame leaves the last sent state alone, so the next tick sends fresh axes
+        if not self._send_frame(self._joy_frame):
+            return
+        self._last_gb = gb
+        self._last_steer = steer
+        self._last_log = logging_enabled
+        self._last_send_ns = now_ns
         # No ack expected for joystick commands
 
     def ping(self):
         """Send a ping and measure round-trip time"""
-        start_time = time.time()
+        start_ns = time.monotonic_ns()
 
-        cmd = {
-            'type': 'ping',
-            'time': start_time,
-            'seq': self.seq
-        }
+        PING.pack_into(self._ping_frame, LENGTH.size, MSG_PING, start_ns, self.seq)
         self.seq += 1
 
-        cmd_json = json.dumps(cmd) + '\n'
-        self.sock.sendall(cmd_json.encode())
-
-        # Wait for response with timeout
-        import select
-        ready = select.select([self.sock], [], [], 2.0)
-
-        if not ready[0]:
-            return {'success': False}
-
         try:
-            data = self.sock.recv(4096).decode()
-            if not data:
+            if not self._send_frame(self._ping_frame):
+                return {'success': False}
+            # The socket stays non-blocking, wait for the reply on the selector
+            if not self._sel.select(timeout=PING_TIMEOUT):
+                return {'success': False}
+            n = self.sock.recv_into(self._rxview)
+            rearm_quickack(self.sock)
+            if n < LENGTH.size + 1:
                 return {'success': False}
 
-            response = json.loads(data.strip().split('\n')[0])
+            length = LENGTH.unpack_from(self._rxbuf)[0]
+            # Only a whole pong frame is a valid reply, a short read or an error frame is not
+            if length != PONG.size or n < LENGTH.size + length:
+                return {'success': False}
+            payload = self._rxview[LENGTH.size:LENGTH.size + length]
 
-            if response['type'] == 'pong':
-                end_time = time.time()
-                rtt = (end_time - start_time) * 1000  # ms
+            if payload[0] == MSG_PONG:
+                _, _, server_recv_ns, server_send_ns, _ = PONG.unpack(payload)
+                rtt_ns = time.monotonic_ns() - start_ns
 
                 return {
                     'success': True,
-                    'rtt_ms': rtt,
-                    'server_processing_ms': (response['server_send_time'] - response['server_recv_time']) * 1000
+                    'rtt_ms': rtt_ns / 1e6,
+                    'server_processing_ms': (server_send_ns - server_recv_ns) / 1e6
                 }
         except Exception as e:
             print(f"Ping error: {e}")
@@ -121,6 +180,8 @@ class ADBJoystickClient:
 
     def close(self):
         """Close the connection"""
+        if self._sel is not None:
+            self._sel.close()
         if self.sock:
             try:
                 self.sock.close()
@@ -170,6 +231,10 @@ class Joystick:
             print("Then log out and back in.")
             sys.exit(1)
 
+        # Poll the device first so idle ticks don't raise BlockingIOError
+        self._poll = select.poll()
+        self._poll.register(self.gamepad.fileno(), select.POLLIN)
+
         # PS4 controller axis codes
         self.AXIS_LEFT_X = ecodes.ABS_X        # Left stick X-axis (steering)
         self.AXIS_LEFT_TRIGGER = ecodes.ABS_Z   # Left trigger (L2) - brake
@@ -186,6 +251,7 @@ class Joystick:
         self.BTN_R1 = 311         # R1 button - right blinker
 
         # Current values
+        self.gb = 0.0  # combined gas/brake
         self.steer = 0.0
         self.left_trigger = 0.0  # brake
         self.right_trigger = 0.0  # gas
@@ -194,59 +260,87 @@ class Joystick:
         self.left_blinker = False
         self.right_blinker = False
 
-        # For axes_values compatibility with send_loop
-        self.axes_values = {'gb': 0.0, 'steer': 0.0}
-        self.axes_order = ['gb', 'steer']
+        # Precompute normalize -> deadzone -> expo for every raw axis value
+        self._steer_lut = tuple(self.shape_steer(normalize_value(raw, 0, AXIS_MAX, 1, -1)) for raw in range(AXIS_MAX + 1))
+        self._trigger_lut = tuple(normalize_value(raw, 0, AXIS_MAX, 0, 1) for raw in range(AXIS_MAX + 1))
+
+        # Event code -> axis slot / button handler tables for read_events
+        self._abs_slots = {
+            self.AXIS_LEFT_X: STEER,
+            self.AXIS_LEFT_TRIGGER: BRAKE,
+            self.ALT_LEFT_TRIGGER: BRAKE,
+            self.AXIS_RIGHT_TRIGGER: GAS,
+            self.ALT_RIGHT_TRIGGER: GAS,
+        }
+        self._key_handlers = {
+            self.BTN_TRIANGLE: self._handle_cancel,
+            self.BTN_X: self._handle_logging_toggle,
+            self.BTN_L1: self._handle_left_blinker,
+            self.BTN_R1: self._handle_right_blinker,
+        }
 
     def apply_expo(self, value):
         """Apply exponential curve for fine control"""
         return EXPO * value ** 3 + (1 - EXPO) * value
 
+    def shape_steer(self, value):
+        """Apply the steering deadzone and expo curve to a normalized value"""
+        # Normalized to -1 to 1 range (inverted so right = positive)
+        if abs(value) < 0.03:
+            value = 0.0
+        return self.apply_expo(value)
+
+    def _handle_cancel(self, value):
+        self.cancel = (value == 1)  # 1 = pressed, 0 = released
+
+    def _handle_logging_toggle(self, value):
+        if value == 1:  # Button pressed (not released)
+            self.logging_enabled = not self.logging_enabled
+            status = "ENABLED" if self.logging_enabled else "DISABLED"
+            print(f"\n*** LOGGING {status} ***")
+
+    def _handle_left_blinker(self, value):
+        self.left_blinker = (value == 1)
+
+    def _handle_right_blinker(self, value):
+        self.right_blinker = (value == 1)
+
     def read_events(self):
         """Read and process controller events (non-blocking)"""
+        abs_slots = self._abs_slots
+        key_handlers = self._key_handlers
+        EV_ABS = ecodes.EV_ABS
+        EV_KEY = ecodes.EV_KEY
+        if not self._poll.poll(0):
+            return True
+
+        # Only the last raw value of each axis in a batch matters
+        raw = [None, None, None]
         try:
             # Read all available events without blocking
             for event in self.gamepad.read():
-                if event.type == ecodes.EV_ABS:  # Absolute axis events
-
-                    # Left stick X-axis (steering)
-                    if event.code == self.AXIS_LEFT_X:
-                        # Normalize to -1 to 1 range (inverted so right = positive)
-                        raw_steer = normalize_value(event.value, 0, 255, 1, -1)
-                        # Apply deadzone
-                        if abs(raw_steer) < 0.03:
-                            raw_steer = 0.0
-                        # Apply expo curve for fine control
-                        self.steer = self.apply_expo(raw_steer)
-
-                    # Left trigger (brake - negative acceleration)
-                    elif event.code in [self.AXIS_LEFT_TRIGGER, self.ALT_LEFT_TRIGGER]:
-                        self.left_trigger = normalize_value(event.value, 0, 255, 0, 1)
-
-                    # Right trigger (gas - positive acceleration)
-                    elif event.code in [self.AXIS_RIGHT_TRIGGER, self.ALT_RIGHT_TRIGGER]:
-                        self.right_trigger = normalize_value(event.value, 0, 255, 0, 1)
-
-                elif event.type == ecodes.EV_KEY:  # Button events
-                    if event.code == self.BTN_TRIANGLE:
-                        self.cancel = (event.value == 1)  # 1 = pressed, 0 = released
-                    elif event.code == self.BTN_X:
-                        if event.value == 1:  # Button pressed (not released)
-                            self.logging_enabled = not self.logging_enabled
-                            status = "ENABLED" if self.logging_enabled else "DISABLED"
-                            print(f"\n*** LOGGING {status} ***")
-                    elif event.code == self.BTN_L1:
-                        self.left_blinker = (event.value == 1)
-                    elif event.code == self.BTN_R1:
-                        self.right_blinker = (event.value == 1)
+                if event.type == EV_ABS:  # Absolute axis events
+                    slot = abs_slots.get(event.code)
+                    if slot is not None:
+                        raw[slot] = event.value
+                elif event.type == EV_KEY:  # Button events
+                    handler = key_handlers.get(event.code)
+                    if handler is not None:
+                        handler(event.value)
+
+            # Left stick X-axis (steering)
+            if raw[STEER] is not None:
+                self.steer = self._steer_lut[min(max(raw[STEER], 0), AXIS_MAX)]
+            # Left trigger (brake - negative acceleration)
+            if raw[BRAKE] is not None:
+                self.left_trigger = self._trigger_lut[min(max(raw[BRAKE], 0), AXIS_MAX)]
+            # Right trigger (gas - positive acceleration)
+            if raw[GAS] is not None:
+                self.right_trigger = self._trigger_lut[min(max(raw[GAS], 0), AXIS_MAX)]
 
             # Calculate combined gas/brake value
             # Right trigger = positive (gas), left trigger = negative (brake)
-            gb = self.right_trigger - self.left_trigger
-
-            # Update axes_values for compatibility
-            self.axes_values['gb'] = gb
-            self.axes_values['steer'] = self.steer
+            self.gb = self.right_trigger - self.left_trigger
 
             return True
 
@@ -271,12 +365,16 @@ class Keyboard:
             print("ERROR: Cannot import KBHit. Keyboard mode requires openpilot environment.")
             sys.exit(1)
 
-        self.axis_increment = 0.05  # 5% of full actuation each key press
-        self.axes_map = {'w': 'gb', 's': 'gb',
-                         'a': 'steer', 'd': 'steer'}
-        self.axes_values = {'gb': 0., 'steer': 0.}
-        self.axes_order = ['gb', 'steer']
+        # Each key press moves an axis one step (5% of full actuation), so the axes only take
+        # the 2 * KEY_STEPS + 1 values precomputed here and never accumulate float error
+        self.step_values = tuple(i / KEY_STEPS for i in range(-KEY_STEPS, KEY_STEPS + 1))
+        self.axes_map = {'w': ('gb', 1), 's': ('gb', -1),
+                         'a': ('steer', 1), 'd': ('steer', -1)}
+        self.steps = {'gb': 0, 'steer': 0}
+        self.gb = 0.
+        self.steer = 0.
         self.cancel = False
+        self.logging_enabled = False  # Logging toggle is gamepad only
 
     def update(self):
         # Check if a key is available (non-blocking)
@@ -286,45 +384,77 @@ class Keyboard:
         key = self.kb.getch().lower()
         self.cancel = False
         if key == 'r':
-            self.axes_values = dict.fromkeys(self.axes_values, 0.)
+            self.steps['gb'] = self.steps['steer'] = 0
+            self.gb = self.steer = 0.
         elif key == 'c':
             self.cancel = True
         elif key in self.axes_map:
-            axis = self.axes_map[key]
-            incr = self.axis_increment if key in ['w', 'a'] else -self.axis_increment
-            self.axes_values[axis] = float(np.clip(self.axes_values[axis] + incr, -1, 1))
+            axis, direction = self.axes_map[key]
+            step = self.steps[axis] = min(max(self.steps[axis] + direction, -KEY_STEPS), KEY_STEPS)
+            setattr(self, axis, self.step_values[step + KEY_STEPS])
         else:
             return True  # Unknown key, but keep running
         return True
 
 
-def send_loop(joystick, client):
-    """Main loop: read joystick and send to comma device via ADB"""
-    from openpilot.common.realtime import Ratekeeper
+def _sleep_until(deadline_ns):
+    """Sleep until an absolute time.monotonic_ns() deadline, spinning for the last SPIN_NS to cut wakeup jitter"""
+    remaining = deadline_ns - time.monotonic_ns() - SPIN_NS
+    if remaining > 0:
+        time.sleep(remaining / 1e9)
+    while time.monotonic_ns() < deadline_ns:
+        pass
 
-    rk = Ratekeeper(100, print_delay_threshold=None)
 
+def send_loop(joystick, client):
+    """Main loop: read joystick and send to comma device via ADB"""
     print("\n" + "="*60)
     print("Sending joystick data to comma device...")
     print("Press Ctrl+C to stop")
     print("="*60 + "\n")
 
+    update = joystick.update
+    send_joystick = client.send_joystick
+    sleep_until = _sleep_until
+    monotonic_ns = time.monotonic_ns
+    # Status goes straight to the byte buffer, flush what print() queued first to keep the order
+    sys.stdout.flush()
+    write = sys.stdout.buffer.write
+    flush = sys.stdout.buffer.flush
+
     frame = 0
+    last_status = None
+    deadline_ns = time.monotonic_ns()
     try:
         while True:
-            # Update joystick state
-            joystick.update()
-
-            # Get axes values in order [gb, steer] or [accel_axis, steer_axis]
-            axes = [joystick.axes_values[ax] for ax in joystick.axes_order]
-
-            # Get logging state if available (gamepad only)
-            logging_enabled = getattr(joystick, 'logging_enabled', False)
-
-            # Send to comma device
+            # Connection errors end the inner loop, so the per-tick path has no exception handling
             try:
-                client.send_joystick(axes, logging_enabled)
-            except Exception as e:
+                while True:
+                    # Update joystick state
+                    update()
+
+                    axes = (joystick.gb, joystick.steer)
+
+                    # Send to comma device
+                    send_joystick(axes, joystick.logging_enabled, monotonic_ns())
+
+                    # Print status at most every 5 frames (20 Hz), and only when the displayed values change
+                    if frame % 5 == 0:
+                        status = (round(axes[0], 2), round(axes[1], 2))
+                        if status != last_status:
+                            write(b'\rgb: %.2f, steer: %.2f' % axes)
+                            flush()
+                            last_status = status
+
+                    frame += 1
+                    # Fixed deadlines so sleep overshoot doesn't accumulate, skip ahead instead of bursting after a stall
+                    deadline_ns += SEND_PERIOD_NS
+                    now_ns = monotonic_ns()
+                    if now_ns - deadline_ns > SEND_PERIOD_NS:
+                        deadline_ns = now_ns
+                    sleep_until(deadline_ns)
+
+            except OSError as e:
                 print(f"\nConnection error: {e}")
                 print("Server may have stopped. Reconnecting...")
                 time.sleep(1)
@@ -335,18 +465,10 @@ def send_loop(joystick, client):
                     print(f"Reconnect failed: {e2}")
                     break
 
-            # Print status every 5 frames (20 Hz for more responsive display)
-            if frame % 5 == 0:
-                values_str = ', '.join(f'{name}: {joystick.axes_values[name]:.2f}' for name in joystick.axes_order)
-                print(f'\r{values_str}', end='', flush=True)
-
-            frame += 1
-            rk.keep_time()
-
     except KeyboardInterrupt:
         print("\n\nStopping...")
         # Send neutral position before disconnecting
-        client.send_joystick([0.0, 0.0])
+        client.send_joystick([0.0, 0.0], False, time.monotonic_ns())
         time.sleep(0.1)
 
 
@@ -458,18 +580,7 @@ Examples:
         joystick = Joystick(args.device)
 
         # Set device to non-blocking mode
-        import fcntl
-        fd = joystick.gamepad.fd
-        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
-    # Import Ratekeeper
-    try:
-        from openpilot.common.realtime import Ratekeeper
-    except ImportError:
-        print("\nERROR: Cannot import openpilot modules.")
-        print("Make sure you're running from the openpilot directory.")
-        sys.exit(1)
+        os.set_blocking(joystick.gamepad.fileno(), False)
 
     # Start main loop
     try:
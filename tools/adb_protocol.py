@@ -0,0 +1,49 @@
+"""
+Wire protocol shared by the ADB joystick client and bridge server
+
+Every frame is a 4-byte big-endian payload length followed by the payload.
+The first payload byte is the message type, the rest is a fixed struct layout
+(error frames append a UTF-8 message after the struct).
+"""
+import socket
+import struct
+
+# Frame header: payload length
+LENGTH = struct.Struct('>I')
+
+MSG_JOYSTICK = 1
+MSG_PING = 2
+MSG_PONG = 3
+MSG_ERROR = 4
+
+# All times are time.monotonic_ns() of the sending side
+# type, gb, steer, loggingEnabled, client time, seq
+JOYSTICK = struct.Struct('>Bff?qI')
+# type, client time, seq
+PING = struct.Struct('>BqI')
+# type, client time, server recv time, server send time, seq
+PONG = struct.Struct('>BqqqI')
+# type, server time, seq + UTF-8 error text
+ERROR = struct.Struct('>BqI')
+
+MAX_PAYLOAD = 4096
+
+SOCKET_BUFFER_SIZE = 8192
+HAS_QUICKACK = hasattr(socket, 'TCP_QUICKACK')  # Linux only
+IPTOS_LOWDELAY = 0x10
+
+
+def set_low_latency(sock):
+    """Tune a connected joystick socket for small, latency sensitive frames"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Small buffers so stale frames can't queue up behind a stall
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, IPTOS_LOWDELAY)
+    rearm_quickack(sock)
+
+
+def rearm_quickack(sock):
+    """Disable delayed ACKs, the kernel clears TCP_QUICKACK again after reads"""
+    if HAS_QUICKACK:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
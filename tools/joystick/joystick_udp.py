@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 import os
+import glob
 import argparse
 import threading
 import socket
 import json
+import struct
 import time
-import numpy as np
-from inputs import UnpluggedError, get_gamepad
 
 from cereal import messaging
 from openpilot.common.params import Params
@@ -15,29 +15,46 @@ from openpilot.system.hardware import HARDWARE
 from openpilot.tools.lib.kbhit import KBHit
 
 EXPO = 0.4
+ONE_MINUS_EXPO = 1 - EXPO
+# Every input class keeps its output in a two element list in this order
+AXES_NAMES = ('gb', 'steer')
+GB, STEER = range(2)
+# Binary UDP gamepad packet, keep in sync with ps4_to_udp.py:
+# flags (reserved, 0), left_stick_x, left_trigger, right_trigger
+UDP_FRAME = struct.Struct('<Bfff')
+
+# Linux struct input_event: timeval (two native longs), type, code, value
+INPUT_EVENT = struct.Struct('llHHi')
+# Event types and codes from linux/input-event-codes.h
+EV_KEY = 0x01
+EV_ABS = 0x03
+ABS_Z = 0x02
+ABS_RX = 0x03
+ABS_RY = 0x04
+ABS_RZ = 0x05
+BTN_NORTH = 0x133
 
 
 class Keyboard:
   def __init__(self):
     self.kb = KBHit()
     self.axis_increment = 0.05  # 5% of full actuation each key press
-    self.axes_map = {'w': 'gb', 's': 'gb',
-                     'a': 'steer', 'd': 'steer'}
-    self.axes_values = {'gb': 0., 'steer': 0.}
-    self.axes_order = ['gb', 'steer']
+    self.axes_map = {'w': GB, 's': GB,
+                     'a': STEER, 'd': STEER}
+    self.axes = [0., 0.]
     self.cancel = False
 
   def update(self):
     key = self.kb.getch().lower()
     self.cancel = False
     if key == 'r':
-      self.axes_values = dict.fromkeys(self.axes_values, 0.)
+      self.axes[GB] = self.axes[STEER] = 0.
     elif key == 'c':
       self.cancel = True
     elif key in self.axes_map:
       axis = self.axes_map[key]
       incr = self.axis_increment if key in ['w', 'a'] else -self.axis_increment
-      self.axes_values[axis] = float(np.clip(self.axes_values[axis] + incr, -1, 1))
+      self.axes[axis] = max(-1., min(1., self.axes[axis] + incr))
     else:
       return False
     return True
@@ -47,8 +64,7 @@ class UdpJoystick:
   def __init__(self, port=9999, timeout=0.1):
     self.port = port
     self.timeout = timeout
-    self.axes_values = {'gb': 0., 'steer': 0.}
-    self.axes_order = ['gb', 'steer']
+    self.axes = [0., 0.]
     self.cancel = False
     self.last_update_time = time.time()
 
@@ -56,39 +72,46 @@ class UdpJoystick:
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.sock.settimeout(self.timeout)
     self.sock.bind(('0.0.0.0', self.port))
+    # Receive buffer reused for every packet
+    self.rxbuf = bytearray(1024)
     print(f"UDP Joystick listening on port {self.port}")
 
   def update(self):
     try:
       # Receive UDP packet
-      data, addr = self.sock.recvfrom(1024)
+      n, addr = self.sock.recvfrom_into(self.rxbuf)
       current_time = time.time()
 
       try:
-        # Parse JSON data
-        gamepad_data = json.loads(data.decode('utf-8'))
+        if n == UDP_FRAME.size:
+          _, left_stick_x, left_trigger, right_trigger = UDP_FRAME.unpack_from(self.rxbuf)
+        else:
+          # Fall back to JSON for older senders
+          gamepad_data = json.loads(self.rxbuf[:n].decode('utf-8'))
 
-        # Extract values
-        left_stick_x = gamepad_data.get('left_stick_x', 0.0)
-        left_trigger = gamepad_data.get('left_trigger', 0.0)
-        right_trigger = gamepad_data.get('right_trigger', 0.0)
+          # Extract values
+          left_stick_x = gamepad_data.get('left_stick_x', 0.0)
+          left_trigger = gamepad_data.get('left_trigger', 0.0)
+          right_trigger = gamepad_data.get('right_trigger', 0.0)
 
         # Apply deadzone
-        left_stick_x = left_stick_x if abs(left_stick_x) > 0.03 else 0.0
-        left_trigger = left_trigger if abs(left_trigger) > 0.03 else 0.0
-        right_trigger = right_trigger if abs(right_trigger) > 0.03 else 0.0
+        if -0.03 <= left_stick_x <= 0.03:
+          left_stick_x = 0.0
+        if -0.03 <= left_trigger <= 0.03:
+          left_trigger = 0.0
+        if -0.03 <= right_trigger <= 0.03:
+          right_trigger = 0.0
 
         # Apply exponential curve for fine control
-        left_stick_x = EXPO * (left_stick_x ** 3) + (1 - EXPO) * left_stick_x if left_stick_x != 0 else 0
+        left_stick_x = EXPO * left_stick_x * left_stick_x * left_stick_x + ONE_MINUS_EXPO * left_stick_x
 
         # Calculate combined acceleration: right trigger (gas) - left trigger (brake)
         accel = float(right_trigger - left_trigger)
-        accel = EXPO * (accel ** 3) + (1 - EXPO) * accel if accel != 0 else 0.0
-        accel = float(np.clip(accel, -1.0, 1.0))
+        accel = EXPO * accel * accel * accel + ONE_MINUS_EXPO * accel
 
         # Update axes values
-        self.axes_values['gb'] = float(np.clip(accel, -1.0, 1.0))
-        self.axes_values['steer'] = float(np.clip(-left_stick_x, -1.0, 1.0))  # Negative for correct steering direction
+        self.axes[GB] = max(-1.0, min(1.0, accel))
+        self.axes[STEER] = max(-1.0, min(1.0, -float(left_stick_x)))  # Negative for correct steering direction
 
         self.last_update_time = current_time
         return True
@@ -104,7 +127,7 @@ class UdpJoystick:
       # Check if we haven't received data for too long
       if time.time() - self.last_update_time > 1.0:
         # Reset to neutral if no data received for 1 second
-        self.axes_values = {'gb': 0., 'steer': 0.}
+        self.axes[GB] = self.axes[STEER] = 0.
       return False
     except Exception as e:
       print(f"UDP receive error: {e}")
@@ -114,52 +137,86 @@ class UdpJoystick:
 class Joystick:
   def __init__(self):
     # This class supports a PlayStation 5 DualSense controller on the comma 3X
-    # TODO: find a way to get this from API or detect gamepad/PC, perhaps "inputs" doesn't support it
-    self.cancel_button = 'BTN_NORTH'  # BTN_NORTH=X/triangle
+    # TODO: find a way to get this from API or detect gamepad/PC
+    self.cancel_button = BTN_NORTH  # BTN_NORTH=X/triangle
     if HARDWARE.get_device_type() == 'pc':
-      accel_axis = 'ABS_Z'
-      steer_axis = 'ABS_RX'
+      accel_axis = ABS_Z
+      steer_axis = ABS_RX
       # TODO: once the longcontrol API is finalized, we can replace this with outputting gas/brake and steering
-      self.flip_map = {'ABS_RZ': accel_axis}
+      self.flip_map = {ABS_RZ: accel_axis}
     else:
-      accel_axis = 'ABS_RX'
-      steer_axis = 'ABS_Z'
-      self.flip_map = {'ABS_RY': accel_axis}
-
-    self.min_axis_value = {accel_axis: 0., steer_axis: 0.}
-    self.max_axis_value = {accel_axis: 255., steer_axis: 255.}
-    self.axes_values = {accel_axis: 0., steer_axis: 0.}
-    self.axes_order = [accel_axis, steer_axis]
+      accel_axis = ABS_RX
+      steer_axis = ABS_Z
+      self.flip_map = {ABS_RY: accel_axis}
+
+    self.code_to_idx = {accel_axis: GB, steer_axis: STEER}
+    self.min_axis_value = [0., 0.]
+    self.max_axis_value = [255., 255.]
+    self.axes = [0., 0.]
     self.cancel = False
+    self.fd = None
 
-  def update(self):
-    try:
-      joystick_event = get_gamepad()[0]
-    except (OSError, UnpluggedError):
-      self.axes_values = dict.fromkeys(self.axes_values, 0.)
+  def open(self):
+    # Same lookup the inputs package used: the first device udev links as an event joystick
+    paths = sorted(glob.glob('/dev/input/by-id/*-event-joystick')) or sorted(glob.glob('/dev/input/by-path/*-event-joystick'))
+    if not paths:
       return False
+    self.fd = os.open(paths[0], os.O_RDONLY)
+    return True
 
-    event = (joystick_event.code, joystick_event.state)
-
-    # flip left trigger to negative accel
-    if event[0] in self.flip_map:
-      event = (self.flip_map[event[0]], -event[1])
+  def update(self):
+    if self.fd is None and not self.open():
+      self.axes[GB] = self.axes[STEER] = 0.
+      time.sleep(0.5)  # no gamepad plugged in, don't spin
+      return False
 
-    if event[0] == self.cancel_button:
-      if event[1] == 1:
-        self.cancel = True
-      elif event[1] == 0:   # state 0 is falling edge
-        self.cancel = False
-    elif event[0] in self.axes_values:
-      self.max_axis_value[event[0]] = max(event[1], self.max_axis_value[event[0]])
-      self.min_axis_value[event[0]] = min(event[1], self.min_axis_value[event[0]])
+    try:
+      # Blocks until the device has events, a single read returns the whole batch of input_event structs
+      data = os.read(self.fd, INPUT_EVENT.size * 64)
+    except OSError:
+      os.close(self.fd)
+      self.fd = None
+      self.axes[GB] = self.axes[STEER] = 0.
+      return False
 
-      norm = -float(np.interp(event[1], [self.min_axis_value[event[0]], self.max_axis_value[event[0]]], [-1., 1.]))
+    code_to_idx = self.code_to_idx
+    min_axis_value = self.min_axis_value
+    max_axis_value = self.max_axis_value
+    # Only the last value of each axis in the batch is normalized
+    raw = [None, None]
+    handled = False
+    for _, _, ev_type, code, value in INPUT_EVENT.iter_unpack(data):
+      if ev_type == EV_ABS:
+        # flip left trigger to negative accel
+        if code in self.flip_map:
+          code, value = self.flip_map[code], -value
+
+        idx = code_to_idx.get(code)
+        if idx is None:
+          continue
+        # Calibration still sees every value so short peaks within a batch widen the range
+        if value < min_axis_value[idx]:
+          min_axis_value[idx] = value
+        elif value > max_axis_value[idx]:
+          max_axis_value[idx] = value
+        raw[idx] = value
+      elif ev_type == EV_KEY and code == self.cancel_button:
+        if value == 1:
+          self.cancel = True
+        elif value == 0:   # state 0 is falling edge
+          self.cancel = False
+      else:
+        continue
+      handled = True
+
+    for idx, value in enumerate(raw):
+      if value is None:
+        continue
+      # Scale to -1..1 (inverted), the value is always within the calibrated range
+      norm = 1. - 2. * (value - min_axis_value[idx]) / (max_axis_value[idx] - min_axis_value[idx])
       norm = norm if abs(norm) > 0.03 else 0.  # center can be noisy, deadzone of 3%
-      self.axes_values[event[0]] = EXPO * norm ** 3 + (1 - EXPO) * norm  # less action near center for fine control
-    else:
-      return False
-    return True
+      self.axes[idx] = EXPO * norm * norm * norm + ONE_MINUS_EXPO * norm  # less action near center for fine control
+    return handled
 
 
 def send_thread(joystick):
@@ -167,17 +224,23 @@ def send_thread(joystick):
 
   rk = Ratekeeper(100, print_delay_threshold=None)
 
+  # Bind everything the 100 Hz loop touches once
+  new_message = messaging.new_message
+  send = pm.send
+  keep_time = rk.keep_time
+
   while True:
+    axes = joystick.axes
     if rk.frame % 20 == 0:
-      print('\n' + ', '.join(f'{name}: {round(v, 3)}' for name, v in joystick.axes_values.items()))
+      print('\n' + ', '.join(f'{name}: {round(v, 3)}' for name, v in zip(AXES_NAMES, axes, strict=True)))
 
-    joystick_msg = messaging.new_message('testJoystick')
+    joystick_msg = new_message('testJoystick')
     joystick_msg.valid = True
-    joystick_msg.testJoystick.axes = [joystick.axes_values[ax] for ax in joystick.axes_order]
+    joystick_msg.testJoystick.axes = axes
 
-    pm.send('testJoystick', joystick_msg)
+    send('testJoystick', joystick_msg)
 
-    rk.keep_time()
+    keep_time()
 
 
 def joystick_control_thread(joystick):
@@ -215,7 +278,8 @@ def main():
     print('- Left stick X: Steering control')
     print('- Left trigger: Brake (negative acceleration)')
     print('- Right trigger: Gas (positive acceleration)')
-    print('- Send JSON data: {"left_stick_x": -1.0 to 1.0, "left_trigger": 0.0 to 1.0, "right_trigger": 0.0 to 1.0}')
+    print(f'- Send {UDP_FRAME.size} byte little-endian packets: flags (u8, 0), left_stick_x (f32, -1.0 to 1.0), left_trigger, right_trigger (f32, 0.0 to 1.0)')
+    print('  or JSON: {"left_stick_x": -1.0 to 1.0, "left_trigger": 0.0 to 1.0, "right_trigger": 0.0 to 1.0}')
     print('Waiting for UDP gamepad data...')
     joystick = UdpJoystick(port=args.port)
   else:
@@ -2,18 +2,73 @@
 
 import math
 import os
-import numpy as np
+import time
 
 from cereal import messaging, car, log
 from opendbc.car.vehicle_model import VehicleModel
-from openpilot.common.realtime import DT_CTRL, Ratekeeper
+from openpilot.common.realtime import DT_CTRL
 from openpilot.common.params import Params
 from openpilot.common.swaglog import cloudlog
 
 LongCtrlState = car.CarControl.Actuators.LongControlState
+_LONG_PID = LongCtrlState.pid
+_LONG_STOPPING = LongCtrlState.stopping
+OpenpilotState = log.SelfdriveState.OpenpilotState
+AlertStatus = log.SelfdriveState.AlertStatus
+AlertSize = log.SelfdriveState.AlertSize
+ButtonType = car.CarState.ButtonEvent.Type
+_REENABLE_BTNS = frozenset({ButtonType.setCruise, ButtonType.resumeCruise, ButtonType.mainCruise, ButtonType.accelCruise})
 
 MAX_LAT_ACCEL = 3.0
+DEG2RAD = math.pi / 180.0
+FRAME_NS = int(DT_CTRL * 1e9)
+# HUD set speed of 55, converted to km/h when stock cruise isn't available
+SET_SPEED = 55.0
+SET_SPEED_KPH = 55 * 1.609
+
+# Joystick link states: never seen, active, lost with the graceful stop countdown running, countdown expired
+JOY_NONE, JOY_ACTIVE, JOY_LOST, JOY_STOPPED = range(4)
+GRACEFUL_STOP_FRAMES = 200  # 2 seconds at 100Hz
+# Braking applied by each state when longitudinal control is off
+STOP_ACCEL = (0.0, 0.0, -1.0, -3.0)
+JOY_ALERTS = ('no_joystick', 'nominal', 'joystick_lost', 'joystick_lost')
 print_loop=1000
+DEBUG = bool(int(os.environ.get('JOYSTICKD_DEBUG', '0')))
+
+# selfdriveState alerts: (state, alertText1, alertText2, alertStatus, alertSize)
+# alertText2 of None is filled in with the graceful stop countdown, None as the whole alert leaves the defaults
+ALERTS = {
+  'no_car_data': (OpenpilotState.disabled, "No Car Data", "Waiting for car connection", AlertStatus.normal, AlertSize.small),
+  'user_disabled': (OpenpilotState.disabled, "System Disabled", "Press cruise button to re-enable", AlertStatus.userPrompt, AlertSize.mid),
+  'joystick_lost': (OpenpilotState.disabled, "JOYSTICK LOST - TAKE CONTROL", None, AlertStatus.critical, AlertSize.full),
+  'no_joystick': (OpenpilotState.disabled, "No Joystick", "Connect joystick input", AlertStatus.normal, AlertSize.small),
+  'nominal': None,
+}
+
+
+def _clip1(x):
+  return -1.0 if x < -1.0 else (1.0 if x > 1.0 else x)
+
+
+def _keep_time(deadline_ns):
+  """Sleep until deadline_ns and return the next frame deadline, skipping any frames that were overrun"""
+  now = time.monotonic_ns()
+  if now < deadline_ns:
+    time.sleep((deadline_ns - now) * 1e-9)
+    return deadline_ns + FRAME_NS
+  return deadline_ns + ((now - deadline_ns) // FRAME_NS + 1) * FRAME_NS
+
+
+def _apply_alert(sd, alert, gsd_sec):
+  if alert is None:
+    return
+  state, text1, text2, status, size = alert
+  sd.state = state
+  sd.alertText1 = text1
+  sd.alertText2 = f"Stopping in {gsd_sec:.1f}s" if text2 is None else text2
+  sd.alertStatus = status
+  sd.alertSize = size
+
 
 def joystickd_thread():
   params = Params()
@@ -25,15 +80,22 @@ def joystickd_thread():
     CP = messaging.log_from_bytes(params.get(params_source, block=True), car.CarParams)
     print(f"joystickd: Got CarParams for {CP.carFingerprint}")
     VM = VehicleModel(CP)
+    calc_curvature = VM.calc_curvature
     print("joystickd: VehicleModel initialized")
 
     sm = messaging.SubMaster(['carState', 'liveParameters', 'testJoystick'], frequency=1. / DT_CTRL)
     pm = messaging.PubMaster(['carControl', 'controlsState', 'selfdriveState', 'onroadEvents'])
+    # PubMaster.send only serializes builders before writing to the msgq socket, so the loop writes to the sockets directly
+    cc_sock = pm.sock['carControl']
+    cs_sock = pm.sock['controlsState']
+    ss_sock = pm.sock['selfdriveState']
+    events_sock = pm.sock['onroadEvents']
 
-    rk = Ratekeeper(100, print_delay_threshold=None)
+    next_frame_ns = time.monotonic_ns() + FRAME_NS
 
     loop_count = 0
     CS_prev = None
+    last_curvature_inputs = None
 
     last_joystick_update = 0
     JOYSTICK_TIMEOUT = 5
@@ -41,12 +103,37 @@ def joystickd_thread():
     system_enabled = False
     user_disabled = False
     joystick_active = False
+    joy_state = JOY_NONE
     graceful_stop_debounce = -1
-    joystick_axes = [0.0, 0.0]  # Initialize and hold last valid value
+    ax0 = ax1 = 0.0  # Initialize and hold last valid joystick axes
+
+    # The loop only writes scalar fields of carControl and controlsState, so one builder each is reused every tick.
+    # Fields the loop only writes conditionally are reset at the top of each tick.
+    cc_msg = messaging.new_message('carControl')
+    cc_msg.valid = True
+    CC = cc_msg.carControl
+    actuators = CC.actuators
+
+    cs_msg = messaging.new_message('controlsState')
+    cs_msg.valid = True
+    controlsState = cs_msg.controlsState
+    controlsState.lateralControlState.init('debugState')
+
+    # The "No Car Data" status never changes, so it is built once and only restamped before each send
+    no_car_msg = messaging.new_message('selfdriveState')
+    no_car_msg.valid = True
+    _apply_alert(no_car_msg.selfdriveState, ALERTS['no_car_data'], 0.0)
+
+    events_msg = messaging.new_message('onroadEvents', 0)
+    events_msg.valid = True
 
     while True:
       try:
         sm.update(0)
+        # SubMaster rebinds updated on every update(), so these are bound per tick
+        updated = sm.updated
+        valid = sm.valid
+        alive = sm.alive
         loop_count += 1
 
         # Publish empty onroadEvents so card.py can initialize
@@ -55,103 +142,93 @@ def joystickd_thread():
         # Periodic logging & onroadEvents publishing
         # ---------------------------------------------------------------------
         if loop_count % 100 == 1:  # Publish at 1Hz
-          events_msg = messaging.new_message('onroadEvents', 0)
-          events_msg.valid = True
-          pm.send('onroadEvents', events_msg)
+          events_msg.logMonoTime = time.monotonic_ns()
+          events_sock.send(events_msg.to_bytes())
 
-        if loop_count % print_loop == 0:  # Print every 5 seconds at 100Hz
-          print(f"joystickd: Loop {loop_count}, alive: carState={sm.alive['carState']}, testJoystick={sm.alive['testJoystick']}")
-          print(f"joystickd: Valid: carState={sm.valid['carState']}, testJoystick={sm.valid['testJoystick']}")
-          print(f"joystickd: Updated: carState={sm.updated['carState']}, testJoystick={sm.updated['testJoystick']}")
-          print(f"joystickd: Joystick: last_update={last_joystick_update}, loops_ago={loop_count - last_joystick_update}, active={joystick_active}")
+        if DEBUG and loop_count % print_loop == 0:  # Print every 5 seconds at 100Hz
+          cloudlog.debug("joystickd: Loop %d, alive: carState=%s, testJoystick=%s", loop_count, alive['carState'], alive['testJoystick'])
+          cloudlog.debug("joystickd: Valid: carState=%s, testJoystick=%s", valid['carState'], valid['testJoystick'])
+          cloudlog.debug("joystickd: Updated: carState=%s, testJoystick=%s", updated['carState'], updated['testJoystick'])
+          cloudlog.debug("joystickd: Joystick: last_update=%d, loops_ago=%d, active=%s",
+                         last_joystick_update, loop_count - last_joystick_update, joystick_active)
 
         # ---------------------------------------------------------------------
         # CarControl message
         # ---------------------------------------------------------------------
-        cc_msg = messaging.new_message('carControl')
-        cc_msg.valid = True
-        CC = cc_msg.carControl
+        cc_msg.logMonoTime = time.monotonic_ns()
+        actuators.accel = 0.0
+        actuators.torque = 0.0
 
         # ---------------------------------------------------------------------
         # Joystick activity detection
         # ---------------------------------------------------------------------
-        if sm.updated["testJoystick"] and sm.valid["testJoystick"]:
+        if updated["testJoystick"] and valid["testJoystick"]:
           last_joystick_update = loop_count
         # Joystick is active if we've seen data within the last 5 loops (50ms at 100Hz)
-        prev_joy = joystick_active
-        joystick_active = (loop_count - last_joystick_update) <= JOYSTICK_TIMEOUT
-
-        # Joystick lost → start countdown
-        if prev_joy and not joystick_active:
-          # Joystick just lost - start 2 second countdown (200 loops at 100Hz)
-          graceful_stop_debounce = 200
-          print("joystickd: JOYSTICK LOST - Starting 2 second graceful stop countdown")
-
-        #joystick reconnected → clear countdown
-        elif joystick_active and not prev_joy:
-          # Joystick reconnected - clear countdown and allow normal operation
+        prev_joy_state = joy_state
+        if (loop_count - last_joystick_update) <= JOYSTICK_TIMEOUT:
+          joy_state = JOY_ACTIVE
           graceful_stop_debounce = -1
-          print("joystickd: JOYSTICK RECONNECTED - Resuming normal operation")
-        #countdown active → decrement
-        elif not joystick_active and graceful_stop_debounce > 0:
+        elif joy_state == JOY_ACTIVE:
+          joy_state = JOY_LOST
+          graceful_stop_debounce = GRACEFUL_STOP_FRAMES
+        elif joy_state == JOY_LOST:
           graceful_stop_debounce -= 1
+          if graceful_stop_debounce == 0:
+            joy_state = JOY_STOPPED
+        joystick_active = joy_state == JOY_ACTIVE
+
+        if joy_state != prev_joy_state:
+          if joy_state == JOY_LOST:
+            cloudlog.warning("joystickd: JOYSTICK LOST - Starting 2 second graceful stop countdown")
+          elif joy_state == JOY_ACTIVE:
+            cloudlog.warning("joystickd: JOYSTICK RECONNECTED - Resuming normal operation")
 
 
         # ---------------------------------------------------------------------
         # SelfdriveState early handling if no car data
         # ---------------------------------------------------------------------
-        if not sm.alive["carState"] or not sm.valid["carState"]:
-          ss = messaging.new_message('selfdriveState')
-          ss.valid = True
-          sd = ss.selfdriveState
-
-          sd.state = log.SelfdriveState.OpenpilotState.disabled
-          sd.alertText1 = "No Car Data"
-          sd.alertText2 = "Waiting for car connection"
-          sd.alertStatus = log.SelfdriveState.AlertStatus.normal
-          sd.alertSize = log.SelfdriveState.AlertSize.small
-          sd.enabled = False
-          sd.active = False
-          sd.engageable = False
-          sd.experimentalMode = False
-
-          pm.send('selfdriveState', ss)
-          rk.keep_time()
+        if not alive["carState"] or not valid["carState"]:
+          no_car_msg.logMonoTime = time.monotonic_ns()
+          ss_sock.send(no_car_msg.to_bytes())
+          next_frame_ns = _keep_time(next_frame_ns)
           continue
 
 
         CS = sm['carState']
-
+        v_ego = CS.vEgo
+        brake_pressed = CS.brakePressed
+        gas_pressed = CS.gasPressed
+        steer_fault_permanent = CS.steerFaultPermanent
 
         # ---------------------------------------------------------------------
         # User override detection (brake, gas, steering)
         # ---------------------------------------------------------------------
         if CS_prev is not None:
-          brake_override = CS.brakePressed and (not CS_prev.brakePressed or not CS.standstill)
-          gas_override = CS.gasPressed and not CS_prev.gasPressed
+          brake_override = brake_pressed and (not CS_prev.brakePressed or not CS.standstill)
+          gas_override = gas_pressed and not CS_prev.gasPressed
           steer_override = CS.steeringPressed  # Not used for disable for now, but still tracked
 
           # Disable system on any override
           if brake_override or gas_override:
             user_disabled = True
             system_enabled = False
-            if loop_count % print_loop == 0:  # Print once per second
+            if DEBUG and loop_count % print_loop == 0:  # Print once per second
               override_type = "BRAKE" if brake_override else "GAS"
-              print(f"joystickd: {override_type} OVERRIDE - System disabled! Press cruise button to re-enable.")
+              cloudlog.debug("joystickd: %s OVERRIDE - System disabled! Press cruise button to re-enable.", override_type)
 
 
         # Check for cruise control button to re-enable
         if user_disabled and len(CS.buttonEvents) > 0:
-          print(f"joystickd: User disabled, checking buttons for re-enable...")
+          if DEBUG:
+            cloudlog.debug("joystickd: User disabled, checking buttons for re-enable...")
           for button in CS.buttonEvents:
-            print(f"  - Checking button type: {button.type}, pressed: {button.pressed}")
-            if button.type in [car.CarState.ButtonEvent.Type.setCruise,
-                             car.CarState.ButtonEvent.Type.resumeCruise,
-                             car.CarState.ButtonEvent.Type.mainCruise,
-                             car.CarState.ButtonEvent.Type.accelCruise] and button.pressed:
+            if DEBUG:
+              cloudlog.debug("joystickd: Checking button type: %s, pressed: %s", button.type, button.pressed)
+            if button.type.raw in _REENABLE_BTNS and button.pressed:
               user_disabled = False
               system_enabled = True
-              print(f"joystickd: CRUISE BUTTON pressed - System re-enabled!")
+              cloudlog.warning("joystickd: CRUISE BUTTON pressed - System re-enabled!")
               break
 
         # If never disabled by user, allow joystick to enable
@@ -161,7 +238,7 @@ def joystickd_thread():
         # ---------------------------------------------------------------------
         # Control mode flags
         # ---------------------------------------------------------------------
-        CC.enabled = system_enabled and not CS.steerFaultPermanent
+        CC.enabled = system_enabled and not steer_fault_permanent
         CC.latActive = CC.enabled and not CS.steerFaultTemporary
         CC.longActive = CC.enabled and CP.openpilotLongitudinalControl
 
@@ -170,57 +247,55 @@ def joystickd_thread():
         CC.cruiseControl.resume = False    # Not using stock cruise resume
 
         CC.hudControl.leadDistanceBars = 2
-        CC.hudControl.setSpeed = 55 * (1.609 if not CS.cruiseState.available else 1)
+        CC.hudControl.setSpeed = SET_SPEED if CS.cruiseState.available else SET_SPEED_KPH
         CC.hudControl.leadVisible = False
 
 
-        if loop_count % print_loop == 0 and joystick_active:
-          print(f"joystickd: enabled={CC.enabled}, latActive={CC.latActive}, longActive={CC.longActive}")
-          print(f"joystickd: CP.openpilotLongitudinalControl={CP.openpilotLongitudinalControl}")
+        if DEBUG and loop_count % print_loop == 0 and joystick_active:
+          cloudlog.debug("joystickd: enabled=%s, latActive=%s, longActive=%s", CC.enabled, CC.latActive, CC.longActive)
+          cloudlog.debug("joystickd: CP.openpilotLongitudinalControl=%s", CP.openpilotLongitudinalControl)
 
         # ---------------------------------------------------------------------
         # Joystick input
         # ---------------------------------------------------------------------
 
         # Update joystick axes if new data available, otherwise keep last value
-        if joystick_active and sm.updated['testJoystick']:
+        if joystick_active and updated['testJoystick']:
           joystick_axes = sm['testJoystick'].axes
-          if loop_count % print_loop == 0:
-            print(f"joystickd: Got joystick axes: {joystick_axes}")
+          ax0 = float(joystick_axes[0])
+          ax1 = float(joystick_axes[1])
+          if DEBUG and loop_count % print_loop == 0:
+            cloudlog.debug("joystickd: Got joystick axes: %.3f, %.3f", ax0, ax1)
         elif not joystick_active:
           # Only reset to zero when joystick is truly inactive
-          joystick_axes = [0.0, 0.0]
-        # else: keep previous joystick_axes value
+          ax0 = ax1 = 0.0
+        # else: keep previous axes values
 
 
-        actuators = CC.actuators
         # ---------------------------------------------------------------------
         # Longitudinal control
         # ---------------------------------------------------------------------
         if CC.longActive:
-          actuators.accel = 4.0 * float(np.clip(joystick_axes[0], -1, 1))
+          actuators.accel = 4.0 * _clip1(ax0)
 
-          if sm['carState'].vEgo > 0.1:
-            actuators.longControlState = LongCtrlState.pid
+          if v_ego > 0.1:
+            actuators.longControlState = _LONG_PID
           elif actuators.accel > 0.1:  # User wants to accelerate
-            actuators.longControlState = LongCtrlState.pid
+            actuators.longControlState = _LONG_PID
           else:
-            actuators.longControlState = LongCtrlState.stopping
+            actuators.longControlState = _LONG_STOPPING
 
-          if loop_count % print_loop == 0:
-            print(f"joystickd: Long control - accel: {actuators.accel:.3f}, state: {actuators.longControlState}, vEgo: {sm['carState'].vEgo:.2f}")
+          if DEBUG and loop_count % print_loop == 0:
+            cloudlog.debug("joystickd: Long control - accel: %.3f, state: %s, vEgo: %.2f", actuators.accel, actuators.longControlState, v_ego)
         else:
-          if graceful_stop_debounce > 0:
-            actuators.accel = -1.0
-          elif graceful_stop_debounce == 0:
-            actuators.accel = -3.0
+          actuators.accel = STOP_ACCEL[joy_state]
 
           actuators.longControlState = (
-            LongCtrlState.pid if sm['carState'].vEgo > 0.1 else LongCtrlState.stopping
+            _LONG_PID if v_ego > 0.1 else _LONG_STOPPING
           )
 
-          if loop_count % print_loop == 0 and joystick_active:
-            print(f"joystickd: Long control DISABLED - CP.openpilotLongitudinalControl={CP.openpilotLongitudinalControl}, enabled={CC.enabled}")
+          if DEBUG and loop_count % print_loop == 0 and joystick_active:
+            cloudlog.debug("joystickd: Long control DISABLED - CP.openpilotLongitudinalControl=%s, enabled=%s", CP.openpilotLongitudinalControl, CC.enabled)
 
 
         # ---------------------------------------------------------------------
@@ -228,37 +303,42 @@ def joystickd_thread():
         # ---------------------------------------------------------------------
         if CC.latActive:
           try:
-            actuators.torque = float(np.clip(joystick_axes[1], -1, 1))
-            if loop_count % print_loop == 0:
+            actuators.torque = _clip1(ax1)
+            if DEBUG and loop_count % print_loop == 0:
               direction = "LEFT" if actuators.torque < -0.2 else ("RIGHT" if actuators.torque > 0.2 else "CENTER")
-              print(f"joystickd: Lat control - torque: {actuators.torque:.3f} ({direction}), angle: {actuators.steeringAngleDeg:.1f}")
+              cloudlog.debug("joystickd: Lat control - torque: %.3f (%s), angle: %.1f", actuators.torque, direction, actuators.steeringAngleDeg)
           except Exception as e:
             print(f"joystickd: ERROR in lateral control: {e}")
 
-        pm.send('carControl', cc_msg)
+        cc_sock.send(cc_msg.to_bytes())
 
 
         # ---------------------------------------------------------------------
         # ControlsState message
         # ---------------------------------------------------------------------
-        cs_msg = messaging.new_message('controlsState')
-        cs_msg.valid = True
-        controlsState = cs_msg.controlsState
-        controlsState.lateralControlState.init('debugState')
+        cs_msg.logMonoTime = time.monotonic_ns()
         try:
           # Simple curvature calculation without live parameter dependencies
-          if sm.alive['liveParameters'] and sm.valid['liveParameters']:
+          steering_angle_deg = CS.steeringAngleDeg
+          if alive['liveParameters'] and valid['liveParameters']:
             lp = sm['liveParameters']
-            steer_angle_without_offset = math.radians(sm['carState'].steeringAngleDeg - lp.angleOffsetDeg)
-            controlsState.curvature = -VM.calc_curvature(steer_angle_without_offset, sm['carState'].vEgo, lp.roll)
+            angle_offset_deg = lp.angleOffsetDeg
+            roll = lp.roll
           else:
             # Fallback: use raw steering angle if liveParameters not available
-            steer_angle = math.radians(sm['carState'].steeringAngleDeg)
-            controlsState.curvature = -VM.calc_curvature(steer_angle, sm['carState'].vEgo, 0.0)
+            angle_offset_deg = 0.0
+            roll = 0.0
+          # Stopped or holding the wheel still, the inputs repeat and the last curvature still holds
+          curvature_inputs = (steering_angle_deg, v_ego, angle_offset_deg, roll)
+          if curvature_inputs != last_curvature_inputs:
+            steer_angle_without_offset = (steering_angle_deg - angle_offset_deg) * DEG2RAD
+            controlsState.curvature = -calc_curvature(steer_angle_without_offset, v_ego, roll)
+            last_curvature_inputs = curvature_inputs
         except Exception as e:
           print(f"joystickd: ERROR in controlsState: {e}")
           controlsState.curvature = 0.0
-        pm.send('controlsState', cs_msg)
+          last_curvature_inputs = None
+        cs_sock.send(cs_msg.to_bytes())
 
         # ---------------------------------------------------------------------
         # SelfdriveState (final status reporting)
@@ -268,36 +348,20 @@ def joystickd_thread():
         selfdriveState = ss_msg.selfdriveState
 
         # Set proper state based on our control logic
-        if user_disabled:
-          selfdriveState.state = log.SelfdriveState.OpenpilotState.disabled
-          selfdriveState.alertText1 = "System Disabled"
-          selfdriveState.alertText2 = "Press cruise button to re-enable"
-          selfdriveState.alertStatus = log.SelfdriveState.AlertStatus.userPrompt
-          selfdriveState.alertSize = log.SelfdriveState.AlertSize.mid
-        elif not joystick_active and graceful_stop_debounce >= 0:
-          selfdriveState.state = log.SelfdriveState.OpenpilotState.disabled
-          selfdriveState.alertText1 = "JOYSTICK LOST - TAKE CONTROL"
-          selfdriveState.alertText2 = f"Stopping in {graceful_stop_debounce / 100:.1f}s"
-          selfdriveState.alertStatus = log.SelfdriveState.AlertStatus.critical
-          selfdriveState.alertSize = log.SelfdriveState.AlertSize.full
-        elif not joystick_active:
-          selfdriveState.state = log.SelfdriveState.OpenpilotState.disabled
-          selfdriveState.alertText1 = "No Joystick"
-          selfdriveState.alertText2 = "Connect joystick input"
-          selfdriveState.alertStatus = log.SelfdriveState.AlertStatus.normal
-          selfdriveState.alertSize = log.SelfdriveState.AlertSize.small
+        alert_key = 'user_disabled' if user_disabled else JOY_ALERTS[joy_state]
+        _apply_alert(selfdriveState, ALERTS[alert_key], graceful_stop_debounce / 100)
 
         selfdriveState.enabled = CC.enabled
         selfdriveState.active = CC.latActive or CC.longActive
-        selfdriveState.engageable = CC.enabled and not CS.steerFaultPermanent
+        selfdriveState.engageable = CC.enabled and not steer_fault_permanent
         selfdriveState.experimentalMode = False
 
-        pm.send('selfdriveState', ss_msg)
+        ss_sock.send(ss_msg.to_bytes())
 
         # Update previous state for override detection
         CS_prev = CS
 
-        rk.keep_time()
+        next_frame_ns = _keep_time(next_frame_ns)
 
       except Exception as e:
         print(f"joystickd: ERROR in main loop: {e}")
@@ -1,195 +1,378 @@
 #!/usr/bin/env python3
 """
 Comprehensive Data Logger for Joystick Control
-Logs all car data, inputs, actuat            # Actuator Commands (What we send)
-            'actuators_accel',
-            'actuators_torque',
-            'actuators_steeringAngleDeg',
-            'actuators_curvature',
-            'actuators_speed',
-            'actuators_longControlState',
-
-            # Car Output (What actually gets sent to car after safety restrictions)
-            'carOutput_valid',
-            'carOutput_accel',
-            'carOutput_torque',
-            'carOutput_steeringAngleDeg',
-            'carOutput_curvature',
-            'carOutput_speed',
-            'carOutput_longControlState',
-
-            # Car Control Flagsds, and control states to CSV
+Logs all car data, inputs, actuator commands, and control states to CSV
 Enable/disable via testJoystick.loggingEnabled field
 """
 
-import csv
+import gc
+import linecache
+import threading
 import time
 import os
+import sys
+import traceback
+import uuid
+from collections import deque
 from pathlib import Path
 from datetime import datetime
 
 from cereal import messaging, car, log
-from openpilot.common.realtime import DT_CTRL, Ratekeeper
+from openpilot.common.realtime import DT_CTRL, Ratekeeper, config_realtime_process
 from openpilot.common.params import Params
+from openpilot.system.hardware import PC
+
+
+def enum_names(enum):
+    """Ordinal -> name table for a capnp enum, so rows don't str() a fresh enum reader every frame"""
+    return {ordinal: name for name, ordinal in enum.schema.enumerants.items()}
+
+
+def union_names(group):
+    """Discriminant -> member name table for a capnp union, read with group.which.raw instead of building a which() str"""
+    schema = group.schema
+    return {schema.fields[name].proto.discriminantValue: name for name in schema.union_fields}
+
+
+GEAR_SHIFTER = enum_names(car.CarState.GearShifter)
+LONG_CONTROL_STATE = enum_names(car.CarControl.Actuators.LongControlState)
+VISUAL_ALERT = enum_names(car.CarControl.HUDControl.VisualAlert)
+AUDIBLE_ALERT = enum_names(car.CarControl.HUDControl.AudibleAlert)
+OPENPILOT_STATE = enum_names(log.SelfdriveState.OpenpilotState)
+ALERT_STATUS = enum_names(log.SelfdriveState.AlertStatus)
+ALERT_SIZE = enum_names(log.SelfdriveState.AlertSize)
+LATERAL_CONTROL_STATE = union_names(log.ControlsState.LateralControlState)
+
+# Rows waiting for the writer thread, ~40 s at 100 Hz. When full, the oldest rows are dropped rather than
+# ever making the control loop wait on the writer
+RING_ROWS = 4096
+# Rows are formatted into memory on the writer thread and handed to the file 64 at a time
+BATCH_ROWS = 64
+# How long the writer thread lets rows queue up between batches, 10 frames at 100 Hz
+WRITER_PERIOD = 0.1
+# The writer thread collects formatted rows into one buffer, so the OS sees one write() per ~1 MiB of rows
+FILE_BUFFER_SIZE = 1 << 20
+# It also writes that buffer out at least this often, so a crash loses at most ~1 s of rows
+FLUSH_PERIOD = 1.0
+# The writer thread fdatasync()s after this many bytes, so the kernel never builds up a large backlog of
+# dirty log pages whose writeback can stall the rest of the device
+SYNC_BYTES = 4 * FILE_BUFFER_SIZE
+
+# The 100 Hz loop runs SCHED_FIFO on big core 5 next to plannerd / radard, at a realtime priority far below
+# theirs (Priority.CTRL_LOW) so a debug logger never preempts them
+LOGGERD_CORE = 5
+LOGGERD_PRIORITY = 5
+
+# capnp telemetry is Float32, good to about 7 significant digits, so there is no point writing the
+# 17 digit repr of the widened double. The timestamp column is a real double and is written as is.
+FLOAT32_FORMAT = '%.7g'
+
+
+# Alert texts come from a handful of templates, so each distinct one is quoted once and that copy is shared by
+# every row logging it. Cleared when full, countdown texts like "Stopping in 1.5s" keep adding new ones.
+CSV_TEXTS = {}
+CSV_TEXTS_SIZE = 256
+
+
+def csv_text(text):
+    """Quote free text the way csv.writer would, so rows can be written with a plain %-format"""
+    quoted = CSV_TEXTS.get(text)
+    if quoted is None:
+        if ',' in text or '"' in text or '\n' in text or '\r' in text:
+            quoted = '"' + text.replace('"', '""') + '"'
+        else:
+            quoted = text
+        if len(CSV_TEXTS) >= CSV_TEXTS_SIZE:
+            CSV_TEXTS.clear()
+        CSV_TEXTS[text] = quoted
+    return quoted
+
+
+def write_all(fd, data):
+    """os.write() all of data, retrying short writes"""
+    written = os.write(fd, data)
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def csv_row_format(row):
+    """%-format for CSV rows typed like row: the timestamp as repr(), other floats with FLOAT32_FORMAT.
+    Text columns go through csv_text() when the row is built"""
+    return ','.join(['%r', *[FLOAT32_FORMAT if v.__class__ is float else '%s' for v in row[1:]]]) + '\r\n'
+
+
+# carState bools, packed into the carState_flags column with CARSTATE_FLAGS[i] at bit i.
+# Read one back with (carState_flags >> CARSTATE_FLAGS.index('gasPressed')) & 1
+CARSTATE_FLAGS = (
+    'standstill',
+    'steeringPressed',
+    'steerFaultTemporary',
+    'steerFaultPermanent',
+    'gasPressed',
+    'brakePressed',
+    'brakeHoldActive',
+    'parkingBrake',
+    'cruiseState.enabled',
+    'cruiseState.available',
+    'cruiseState.standstill',
+    'leftBlinker',
+    'rightBlinker',
+    'genericToggle',
+    'doorOpen',
+    'seatbeltUnlatched',
+    'espDisabled',
+    'stockAeb',
+    'stockFcw',
+    'espActive',
+    'accFaulted',
+)
+
+# liveParameters and selfdriveState are much slower than carState, so their columns are built once per
+# message into a tuple that the rows in between reuse. carOutput goes the same way: it doesn't exist on
+# every setup, and while it's missing its columns are built once and then cost nothing per row
+LIVE_PARAMETERS_COLUMNS = (
+    ('liveParameters_valid', 'lp is not None'),
+    ('liveParameters_angleOffsetDeg', 'lp.angleOffsetDeg if lp else 0.0'),
+    ('liveParameters_angleOffsetAverageDeg', 'lp.angleOffsetAverageDeg if lp else 0.0'),
+    ('liveParameters_stiffnessFactor', 'lp.stiffnessFactor if lp else 0.0'),
+    ('liveParameters_steerRatio', 'lp.steerRatio if lp else 0.0'),
+    ('liveParameters_roll', 'lp.roll if lp else 0.0'),
+)
+CAR_OUTPUT_COLUMNS = (
+    ('carOutput_valid', 'co_act is not None'),
+    ('carOutput_accel', 'co_act.accel if co_act else 0.0'),
+    ('carOutput_torque', 'co_act.torque if co_act else 0.0'),
+    ('carOutput_steeringAngleDeg', 'co_act.steeringAngleDeg if co_act else 0.0'),
+    ('carOutput_curvature', 'co_act.curvature if co_act else 0.0'),
+    ('carOutput_speed', 'co_act.speed if co_act else 0.0'),
+    ('carOutput_longControlState', "LONG_CONTROL_STATE[co_act.longControlState.raw] if co_act else 'none'"),
+)
+SELFDRIVE_STATE_COLUMNS = (
+    ('selfdriveState_state', 'OPENPILOT_STATE[selfdriveState.state.raw]'),
+    ('selfdriveState_enabled', 'selfdriveState.enabled'),
+    ('selfdriveState_active', 'selfdriveState.active'),
+    ('selfdriveState_engageable', 'selfdriveState.engageable'),
+    ('selfdriveState_alertText1', 'csv_text(selfdriveState.alertText1)'),
+    ('selfdriveState_alertText2', 'csv_text(selfdriveState.alertText2)'),
+    ('selfdriveState_alertStatus', 'ALERT_STATUS[selfdriveState.alertStatus.raw]'),
+    ('selfdriveState_alertSize', 'ALERT_SIZE[selfdriveState.alertSize.raw]'),
+)
+
+
+def cached_columns(columns, name):
+    """Schema entries reading columns back out of the prebuilt tuple name"""
+    return tuple((header, f'{name}[{i}]') for i, (header, _) in enumerate(columns))
+
+
+# Every CSV column as (header, expression). The expressions read the arguments of build_row() and are
+# compiled into one straight-line function, so a frame costs a single call with no per-column dispatch.
+SCHEMA = (
+    # Timestamp
+    ('timestamp', 'now()'),
+    ('logMonoTime', "sm.logMonoTime['carState']"),
+    ('loop_count', "system_state['loop_count']"),
+    ('session_id', 'session_id'),
+
+    # System State
+    ('system_enabled', "system_state['system_enabled']"),
+    ('controls_allowed', "system_state['controls_allowed']"),
+    ('lat_active', 'CC.latActive'),
+    ('long_active', 'CC.longActive'),
+    ('joystick_active', "system_state['joystick_active']"),
+
+    # Joystick Inputs (Raw)
+    ('joy_axis_0_gb', 'axes[0] if len(axes) > 0 else 0.0'),
+    ('joy_axis_1_steer', 'axes[1] if len(axes) > 1 else 0.0'),
+    ('joy_button_count', 'len(joy.buttons)'),
+    ('joy_logging_enabled', 'joy.loggingEnabled'),
+
+    # Car State - Motion
+    ('vEgo', 'CS.vEgo'),
+    ('vEgoRaw', 'CS.vEgoRaw'),
+    ('aEgo', 'CS.aEgo'),
+    ('yawRate', 'CS.yawRate'),
+    ('wheelSpeeds_fl', 'CS.wheelSpeeds.fl'),
+    ('wheelSpeeds_fr', 'CS.wheelSpeeds.fr'),
+    ('wheelSpeeds_rl', 'CS.wheelSpeeds.rl'),
+    ('wheelSpeeds_rr', 'CS.wheelSpeeds.rr'),
+
+    # Car State - Steering
+    ('steeringAngleDeg', 'CS.steeringAngleDeg'),
+    ('steeringRateDeg', 'CS.steeringRateDeg'),
+    ('steeringTorque', 'CS.steeringTorque'),
+    ('steeringTorqueEps', 'CS.steeringTorqueEps'),
+    ('steerWarning', 'CS.steerWarning'),
+
+    # Car State - Pedals
+    ('gas', 'CS.gas'),
+    ('brake', 'CS.brake'),
+
+    # Car State - Gear & Cruise
+    ('gearShifter', 'GEAR_SHIFTER[CS.gearShifter.raw]'),
+    ('cruiseState_speed', 'CS.cruiseState.speed'),
+
+    # Car State - Flags, see CARSTATE_FLAGS
+    ('carState_flags', ' | '.join(f'CS.{name} << {bit}' for bit, name in enumerate(CARSTATE_FLAGS))),
+
+    # Live Parameters, cached between liveParameters messages
+    *cached_columns(LIVE_PARAMETERS_COLUMNS, 'lp_cols'),
+
+    # Actuator Commands (What we're sending)
+    ('actuators_accel', 'act.accel'),
+    ('actuators_torque', 'act.torque'),
+    ('actuators_steeringAngleDeg', 'act.steeringAngleDeg'),
+    ('actuators_curvature', 'act.curvature'),
+    ('actuators_speed', 'act.speed'),
+    ('actuators_longControlState', 'LONG_CONTROL_STATE[act.longControlState.raw]'),
+
+    # Car Output (What actually gets sent to car after safety restrictions)
+    *cached_columns(CAR_OUTPUT_COLUMNS, 'co_cols'),
+
+    # Car Control Flags
+    ('enabled', 'CC.enabled'),
+    ('latActive', 'CC.latActive'),
+    ('longActive', 'CC.longActive'),
+    ('leftBlinker_cmd', 'CC.leftBlinker'),
+    ('rightBlinker_cmd', 'CC.rightBlinker'),
+
+    # Cruise Control Commands
+    ('cruiseControl_cancel', 'CC.cruiseControl.cancel'),
+    ('cruiseControl_override', 'CC.cruiseControl.override'),
+    ('cruiseControl_resume', 'CC.cruiseControl.resume'),
+
+    # HUD Control
+    ('hudControl_setSpeed', 'hud.setSpeed'),
+    ('hudControl_leadVisible', 'hud.leadVisible'),
+    ('hudControl_leadDistanceBars', 'hud.leadDistanceBars'),
+    ('hudControl_visualAlert', 'VISUAL_ALERT[hud.visualAlert.raw]'),
+    ('hudControl_audibleAlert', 'AUDIBLE_ALERT[hud.audibleAlert.raw]'),
+    ('hudControl_rightLaneVisible', 'hud.rightLaneVisible'),
+    ('hudControl_leftLaneVisible', 'hud.leftLaneVisible'),
+    ('hudControl_rightLaneDepart', 'hud.rightLaneDepart'),
+    ('hudControl_leftLaneDepart', 'hud.leftLaneDepart'),
+
+    # Controls State
+    ('controlsState_curvature', 'controlsState.curvature'),
+    ('controlsState_lateralControlState', 'LATERAL_CONTROL_STATE[controlsState.lateralControlState.which.raw]'),
+
+    # Selfdrive State, cached between selfdriveState messages
+    *cached_columns(SELFDRIVE_STATE_COLUMNS, 'sds_cols'),
+
+    # CAN Message Stats (if available)
+    ('can_valid', "system_state['can_valid']"),
+    ('can_error_count', '0'),
+)
+BUILD_ROW_ARGS = 'session_id, sm, CS, CC, act, hud, joy, axes, lp_cols, co_cols, controlsState, sds_cols, system_state'
+# Functions and tables the expressions use, bound as keyword-only defaults of build_row() so every
+# use is a LOAD_FAST instead of a globals / builtins lookup
+BUILD_ROW_LOCALS = {
+    'now': time.time,
+    'len': len,
+    'csv_text': csv_text,
+    'GEAR_SHIFTER': GEAR_SHIFTER,
+    'LONG_CONTROL_STATE': LONG_CONTROL_STATE,
+    'VISUAL_ALERT': VISUAL_ALERT,
+    'AUDIBLE_ALERT': AUDIBLE_ALERT,
+    'OPENPILOT_STATE': OPENPILOT_STATE,
+    'ALERT_STATUS': ALERT_STATUS,
+    'ALERT_SIZE': ALERT_SIZE,
+    'LATERAL_CONTROL_STATE': LATERAL_CONTROL_STATE,
+}
+
+
+def codegen_row_builder(func_name, schema, args):
+    """Compile (header, expression) pairs into a func_name(args) function returning the row tuple"""
+    columns = ''.join(f'        {expr},  # {name}\n' for name, expr in schema)
+    bound = ', '.join(f'{name}={name}' for name in BUILD_ROW_LOCALS)
+    src = f'def {func_name}({args}, *, {bound}):\n    return (\n{columns}    )\n'
+
+    # Give the generated source a filename linecache knows, so a traceback shows the failing column
+    filename = f'<loggerd {func_name}>'
+    linecache.cache[filename] = (len(src), None, src.splitlines(keepends=True), filename)
+    namespace = dict(BUILD_ROW_LOCALS)
+    exec(compile(src, filename, 'exec'), namespace)
+    return namespace[func_name]
+
+
+CSV_HEADERS = tuple(name for name, _ in SCHEMA)
+build_row = codegen_row_builder('build_row', SCHEMA, BUILD_ROW_ARGS)
+build_live_parameters = codegen_row_builder('build_live_parameters', LIVE_PARAMETERS_COLUMNS, 'lp')
+build_car_output = codegen_row_builder('build_car_output', CAR_OUTPUT_COLUMNS, 'co_act')
+build_selfdrive_state = codegen_row_builder('build_selfdrive_state', SELFDRIVE_STATE_COLUMNS, 'selfdriveState')
 
 
 class ComprehensiveLogger:
     def __init__(self):
-        self.csv_writer = None
-        self.csv_file = None
+        self.log_fd = None
+        self.rows = None
+        self.stop_writer = None
+        self.writer = None
+        # Set by the writer thread when it gives up on the file, log_frame() then ends the session
+        self.writer_error = None
         self.logging_enabled = False
         self.log_dir = Path("/data/joystick_logs")
         self.log_dir.mkdir(parents=True, exist_ok=True)
         self.current_log_path = None
+        self.session_id = None
         self.row_count = 0
+        self.dropped_rows = 0
+        # Slow or optional message columns, and the logMonoTime of the message they were built from
+        self.live_parameters = None
+        self.live_parameters_time = -1
+        self.car_output = None
+        self.car_output_time = -1
+        self.selfdrive_state = None
+        self.selfdrive_state_time = -1
 
     def get_csv_headers(self):
         """Define all CSV column headers - COMPREHENSIVE list"""
-        return [
-            # Timestamp
-            'timestamp',
-            'logMonoTime',
-            'loop_count',
-
-            # System State
-            'system_enabled',
-            'controls_allowed',
-            'lat_active',
-            'long_active',
-            'joystick_active',
-
-            # Joystick Inputs (Raw)
-            'joy_axis_0_gb',
-            'joy_axis_1_steer',
-            'joy_button_count',
-            'joy_logging_enabled',
-
-            # Car State - Motion
-            'vEgo',
-            'vEgoRaw',
-            'aEgo',
-            'yawRate',
-            'standstill',
-            'wheelSpeeds_fl',
-            'wheelSpeeds_fr',
-            'wheelSpeeds_rl',
-            'wheelSpeeds_rr',
-
-            # Car State - Steering
-            'steeringAngleDeg',
-            'steeringRateDeg',
-            'steeringTorque',
-            'steeringTorqueEps',
-            'steeringPressed',
-            'steerFaultTemporary',
-            'steerFaultPermanent',
-            'steerWarning',
-
-            # Car State - Pedals
-            'gas',
-            'gasPressed',
-            'brake',
-            'brakePressed',
-            'brakeHoldActive',
-            'parkingBrake',
-
-            # Car State - Gear & Cruise
-            'gearShifter',
-            'cruiseState_enabled',
-            'cruiseState_available',
-            'cruiseState_speed',
-            'cruiseState_standstill',
-
-            # Car State - Buttons
-            'leftBlinker',
-            'rightBlinker',
-            'genericToggle',
-            'doorOpen',
-            'seatbeltUnlatched',
-            'espDisabled',
-
-            # Car State - Faults
-            'stockAeb',
-            'stockFcw',
-            'espActive',
-            'accFaulted',
-
-            # Live Parameters
-            'liveParameters_valid',
-            'liveParameters_angleOffsetDeg',
-            'liveParameters_angleOffsetAverageDeg',
-            'liveParameters_stiffnessFactor',
-            'liveParameters_steerRatio',
-            'liveParameters_roll',
-
-            # Actuator Commands (What we're sending)
-            'actuators_accel',
-            'actuators_torque',
-            'actuators_steeringAngleDeg',
-            'actuators_curvature',
-            'actuators_speed',
-            'actuators_longControlState',
-
-            # Car Control Flags
-            'enabled',
-            'latActive',
-            'longActive',
-            'leftBlinker_cmd',
-            'rightBlinker_cmd',
-
-            # Cruise Control Commands
-            'cruiseControl_cancel',
-            'cruiseControl_override',
-            'cruiseControl_resume',
-
-            # HUD Control
-            'hudControl_setSpeed',
-            'hudControl_leadVisible',
-            'hudControl_leadDistanceBars',
-            'hudControl_visualAlert',
-            'hudControl_audibleAlert',
-            'hudControl_rightLaneVisible',
-            'hudControl_leftLaneVisible',
-            'hudControl_rightLaneDepart',
-            'hudControl_leftLaneDepart',
-
-            # Controls State
-            'controlsState_curvature',
-            'controlsState_lateralControlState',
-
-            # Selfdrive State
-            'selfdriveState_state',
-            'selfdriveState_enabled',
-            'selfdriveState_active',
-            'selfdriveState_engageable',
-            'selfdriveState_alertText1',
-            'selfdriveState_alertText2',
-            'selfdriveState_alertStatus',
-            'selfdriveState_alertSize',
-
-            # CAN Message Stats (if available)
-            'can_valid',
-            'can_error_count',
-        ]
+        return CSV_HEADERS
+
+    def open_day_log(self):
+        """Open the day's CSV log file for appending, returns (path, fd, new_file).
+        A file whose header doesn't match CSV_HEADERS (written by another schema earlier in the day)
+        is left alone, the session rolls over to joystick_log_YYYYMMDD_1.csv, _2, ..."""
+        # One file per day rather than per session, rows carry a session_id to tell sessions apart
+        day = f"{datetime.now():%Y%m%d}"
+        header = (','.join(self.get_csv_headers()) + '\r\n').encode()
+        seq = 0
+        while True:
+            path = self.log_dir / (f"joystick_log_{day}.csv" if seq == 0 else f"joystick_log_{day}_{seq}.csv")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size == 0 or os.pread(fd, len(header), 0) == header:
+                    return path, fd, size == 0
+            except OSError:
+                os.close(fd)
+                raise
+            os.close(fd)
+            seq += 1
 
     def start_logging(self):
-        """Start a new CSV log file"""
+        """Start a new logging session, appended to the day's CSV log file"""
         if self.logging_enabled:
             print("loggerd: Already logging!")
             return
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.current_log_path = self.log_dir / f"joystick_log_{timestamp}.csv"
-
         try:
-            self.csv_file = open(self.current_log_path, 'w', newline='')
-            self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=self.get_csv_headers())
-            self.csv_writer.writeheader()
-            self.csv_file.flush()
+            self.current_log_path, self.log_fd, new_file = self.open_day_log()
+            self.session_id = uuid.uuid4().hex
+            # Fresh ring per session, so a writer that died can't leave rows behind for the next one
+            self.rows = deque(maxlen=RING_ROWS)
+            self.stop_writer = threading.Event()
+            self.writer_error = None
+            headers = self.get_csv_headers() if new_file else None
+            self.writer = threading.Thread(target=self.writer_thread, args=(self.log_fd, self.rows, self.stop_writer, headers), daemon=True)
+            self.writer.start()
 
             self.logging_enabled = True
             self.row_count = 0
-            print(f"loggerd: ✓ Started logging to {self.current_log_path}")
+            self.dropped_rows = 0
+            self.live_parameters_time = -1
+            self.car_output_time = -1
+            self.selfdrive_state_time = -1
+            print(f"loggerd: ✓ Started logging session {self.session_id} to {self.current_log_path}")
 
         except Exception as e:
             print(f"loggerd: ERROR starting log file: {e}")
@@ -201,178 +384,121 @@ class ComprehensiveLogger:
             return
 
         try:
-            if self.csv_file:
-                self.csv_file.flush()
-                self.csv_file.close()
-                self.csv_file = None
-                self.csv_writer = None
-
-            print(f"loggerd: ✓ Stopped logging. Wrote {self.row_count} rows to {self.current_log_path}")
+            if self.log_fd is not None:
+                self.stop_writer.set()
+                self.writer.join()
+                self.writer = None
+                os.close(self.log_fd)
+                self.log_fd = None
+
+            if self.writer_error is not None:
+                print(f"loggerd: ✗ Stopped logging after a write error, rows since the last flush to {self.current_log_path} were lost")
+            else:
+                dropped = f" ({self.dropped_rows} dropped, writer fell behind)" if self.dropped_rows else ""
+                print(f"loggerd: ✓ Stopped logging. Wrote {self.row_count - self.dropped_rows} rows{dropped} to {self.current_log_path}")
             self.logging_enabled = False
             self.row_count = 0
 
         except Exception as e:
             print(f"loggerd: ERROR stopping log: {e}")
 
-    def log_frame(self, sm, CC, controlsState, selfdriveState, system_state):
-        """Log a single frame of data"""
-        if not self.logging_enabled or not self.csv_writer:
-            return
+    def writer_thread(self, log_fd, rows, stop, headers):
+        """Format queued rows as CSV and write them to log_fd in batches, until stop is set.
+        headers is None when appending to a file that already has them"""
+        # Threads inherit the control loop's SCHED_FIFO and core pinning, the blocking file I/O runs as a normal thread
+        if sys.platform == 'linux' and not PC:
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            os.sched_setaffinity(0, range(os.cpu_count()))
+
+        chunk = [','.join(headers) + '\r\n'] if headers else []
+        pending = BATCH_ROWS  # write the header right away
+        row_format = None
+        file_buffer = bytearray()
+        unsynced = 0
+        last_write = time.monotonic()
 
         try:
-            CS = sm['carState']
-            joy = sm['testJoystick']
-            lp = sm['liveParameters'] if sm.valid.get('liveParameters', False) else None
-            carOutput = sm['carOutput'] if sm.valid.get('carOutput', False) else None
-
-            # Build comprehensive data row
-            row = {
-                # Timestamp
-                'timestamp': time.time(),
-                'logMonoTime': sm.logMonoTime.get('carState', 0),
-                'loop_count': system_state.get('loop_count', 0),
-
-                # System State
-                'system_enabled': system_state.get('system_enabled', False),
-                'controls_allowed': system_state.get('controls_allowed', False),
-                'lat_active': CC.latActive,
-                'long_active': CC.longActive,
-                'joystick_active': system_state.get('joystick_active', False),
-
-                # Joystick Inputs
-                'joy_axis_0_gb': joy.axes[0] if len(joy.axes) > 0 else 0.0,
-                'joy_axis_1_steer': joy.axes[1] if len(joy.axes) > 1 else 0.0,
-                'joy_button_count': len(joy.buttons) if hasattr(joy, 'buttons') else 0,
-                'joy_logging_enabled': getattr(joy, 'loggingEnabled', False),
-
-                # Car State - Motion
-                'vEgo': CS.vEgo,
-                'vEgoRaw': CS.vEgoRaw,
-                'aEgo': CS.aEgo,
-                'yawRate': CS.yawRate,
-                'standstill': CS.standstill,
-                'wheelSpeeds_fl': CS.wheelSpeeds.fl,
-                'wheelSpeeds_fr': CS.wheelSpeeds.fr,
-                'wheelSpeeds_rl': CS.wheelSpeeds.rl,
-                'wheelSpeeds_rr': CS.wheelSpeeds.rr,
-
-                # Car State - Steering
-                'steeringAngleDeg': CS.steeringAngleDeg,
-                'steeringRateDeg': CS.steeringRateDeg,
-                'steeringTorque': CS.steeringTorque,
-                'steeringTorqueEps': CS.steeringTorqueEps,
-                'steeringPressed': CS.steeringPressed,
-                'steerFaultTemporary': CS.steerFaultTemporary,
-                'steerFaultPermanent': CS.steerFaultPermanent,
-                'steerWarning': CS.steerWarning,
-
-                # Car State - Pedals
-                'gas': CS.gas,
-                'gasPressed': CS.gasPressed,
-                'brake': CS.brake,
-                'brakePressed': CS.brakePressed,
-                'brakeHoldActive': CS.brakeHoldActive,
-                'parkingBrake': CS.parkingBrake,
-
-                # Car State - Gear & Cruise
-                'gearShifter': str(CS.gearShifter),
-                'cruiseState_enabled': CS.cruiseState.enabled,
-                'cruiseState_available': CS.cruiseState.available,
-                'cruiseState_speed': CS.cruiseState.speed,
-                'cruiseState_standstill': CS.cruiseState.standstill,
-
-                # Car State - Buttons
-                'leftBlinker': CS.leftBlinker,
-                'rightBlinker': CS.rightBlinker,
-                'genericToggle': CS.genericToggle,
-                'doorOpen': CS.doorOpen,
-                'seatbeltUnlatched': CS.seatbeltUnlatched,
-                'espDisabled': CS.espDisabled,
-
-                # Car State - Faults
-                'stockAeb': CS.stockAeb,
-                'stockFcw': CS.stockFcw,
-                'espActive': getattr(CS, 'espActive', False),
-                'accFaulted': CS.accFaulted,
-
-                # Live Parameters
-                'liveParameters_valid': sm.valid.get('liveParameters', False) if lp else False,
-                'liveParameters_angleOffsetDeg': lp.angleOffsetDeg if lp else 0.0,
-                'liveParameters_angleOffsetAverageDeg': lp.angleOffsetAverageDeg if lp else 0.0,
-                'liveParameters_stiffnessFactor': lp.stiffnessFactor if lp else 0.0,
-                'liveParameters_steerRatio': lp.steerRatio if lp else 0.0,
-                'liveParameters_roll': lp.roll if lp else 0.0,
-
-                # Actuator Commands
-                'actuators_accel': CC.actuators.accel,
-                'actuators_torque': CC.actuators.torque,
-                'actuators_steeringAngleDeg': CC.actuators.steeringAngleDeg,
-                'actuators_curvature': CC.actuators.curvature,
-                'actuators_speed': CC.actuators.speed,
-                'actuators_longControlState': str(CC.actuators.longControlState),
-
-                # Car Output (Actual output sent to car after safety restrictions)
-                'carOutput_valid': sm.valid.get('carOutput', False),
-                'carOutput_accel': carOutput.actuatorsOutput.accel if carOutput else 0.0,
-                'carOutput_torque': carOutput.actuatorsOutput.torque if carOutput else 0.0,
-                'carOutput_steeringAngleDeg': carOutput.actuatorsOutput.steeringAngleDeg if carOutput else 0.0,
-                'carOutput_curvature': carOutput.actuatorsOutput.curvature if carOutput else 0.0,
-                'carOutput_speed': carOutput.actuatorsOutput.speed if carOutput else 0.0,
-                'carOutput_longControlState': str(carOutput.actuatorsOutput.longControlState) if carOutput else 'none',
-
-                # Car Control Flags
-                'enabled': CC.enabled,
-                'latActive': CC.latActive,
-                'longActive': CC.longActive,
-                'leftBlinker_cmd': CC.leftBlinker,
-                'rightBlinker_cmd': CC.rightBlinker,
-
-                # Cruise Control Commands
-                'cruiseControl_cancel': CC.cruiseControl.cancel,
-                'cruiseControl_override': CC.cruiseControl.override,
-                'cruiseControl_resume': CC.cruiseControl.resume,
-
-                # HUD Control
-                'hudControl_setSpeed': CC.hudControl.setSpeed,
-                'hudControl_leadVisible': CC.hudControl.leadVisible,
-                'hudControl_leadDistanceBars': CC.hudControl.leadDistanceBars,
-                'hudControl_visualAlert': str(CC.hudControl.visualAlert),
-                'hudControl_audibleAlert': str(CC.hudControl.audibleAlert),
-                'hudControl_rightLaneVisible': CC.hudControl.rightLaneVisible,
-                'hudControl_leftLaneVisible': CC.hudControl.leftLaneVisible,
-                'hudControl_rightLaneDepart': CC.hudControl.rightLaneDepart,
-                'hudControl_leftLaneDepart': CC.hudControl.leftLaneDepart,
-
-                # Controls State
-                'controlsState_curvature': controlsState.curvature,
-                'controlsState_lateralControlState': str(controlsState.lateralControlState.which()),
-
-                # Selfdrive State
-                'selfdriveState_state': str(selfdriveState.state),
-                'selfdriveState_enabled': selfdriveState.enabled,
-                'selfdriveState_active': selfdriveState.active,
-                'selfdriveState_engageable': selfdriveState.engageable,
-                'selfdriveState_alertText1': selfdriveState.alertText1,
-                'selfdriveState_alertText2': selfdriveState.alertText2,
-                'selfdriveState_alertStatus': str(selfdriveState.alertStatus),
-                'selfdriveState_alertSize': str(selfdriveState.alertSize),
-
-                # CAN Stats
-                'can_valid': sm.valid.get('can', True),
-                'can_error_count': getattr(sm.get('can', None), 'canErrorCounter', 0) if sm.get('can') else 0,
-            }
-
-            self.csv_writer.writerow(row)
-            self.row_count += 1
-
-            # Flush every 100 rows to prevent data loss
-            if self.row_count % 100 == 0:
-                self.csv_file.flush()
+            while True:
+                # The flush deadline is checked on every wakeup, not only once a batch is full, so a short or idle
+                # session still reaches the file within FLUSH_PERIOD
+                now = time.monotonic()
+                flush = now - last_write >= FLUSH_PERIOD
+                if pending >= BATCH_ROWS or flush:
+                    file_buffer += ''.join(chunk).encode()
+                    chunk.clear()
+                    pending = 0
+
+                if len(file_buffer) >= FILE_BUFFER_SIZE or flush:
+                    if file_buffer:
+                        write_all(log_fd, file_buffer)
+                        unsynced += len(file_buffer)
+                        file_buffer.clear()
+                    last_write = now
+                    if unsynced >= SYNC_BYTES:
+                        os.fdatasync(log_fd)
+                        unsynced = 0
+
+                # Wake up every WRITER_PERIOD, or right away to finish up, and format all the frames queued since
+                # then. Only this thread pops, so len(rows) rows are always there to take
+                done = stop.wait(WRITER_PERIOD)
+                batch = [rows.popleft() for _ in range(len(rows))]
+                if batch:
+                    # Every column keeps its type, so the first row fixes a single %-format for all of them
+                    if row_format is None:
+                        row_format = csv_row_format(batch[0])
+                    chunk.extend([row_format % row for row in batch])
+                    pending += len(batch)
+
+                if done:
+                    file_buffer += ''.join(chunk).encode()
+                    write_all(log_fd, file_buffer)
+                    os.fsync(log_fd)
+                    return
 
         except Exception as e:
-            print(f"loggerd: ERROR logging frame: {e}")
-            import traceback
+            print(f"loggerd: ERROR writing log file: {e}")
             traceback.print_exc()
+            self.writer_error = e
+
+    def log_frame(self, sm, CC, controlsState, selfdriveState, system_state):
+        """Log a single frame of data, errors propagate to loggerd_thread"""
+        valid = sm.valid
+        if not (self.logging_enabled and self.writer and valid['carState'] and valid['carControl']):
+            return
+        if self.writer_error is not None:
+            # The writer is gone (ENOSPC, EIO, ...), stop instead of queueing rows nothing will ever write
+            print(f"loggerd: ERROR log writer failed ({self.writer_error}), stopping logging")
+            self.stop_logging()
+            return
+
+        self.emit_row(self.collect_row(sm, valid, CC, controlsState, selfdriveState, system_state))
+
+    def collect_row(self, sm, valid, CC, controlsState, selfdriveState, system_state):
+        """Read this frame's row out of the messages, in CSV_HEADERS order"""
+        # Only re-read the slow and optional messages when a new one arrived. sm.updated isn't enough, it only
+        # covers this update() and rows aren't logged on every loop
+        mono_time = sm.logMonoTime
+        if mono_time['liveParameters'] != self.live_parameters_time:
+            self.live_parameters_time = mono_time['liveParameters']
+            self.live_parameters = build_live_parameters(sm['liveParameters'] if valid['liveParameters'] else None)
+        if mono_time['carOutput'] != self.car_output_time:
+            self.car_output_time = mono_time['carOutput']
+            self.car_output = build_car_output(sm['carOutput'].actuatorsOutput if valid['carOutput'] else None)
+        if mono_time['selfdriveState'] != self.selfdrive_state_time:
+            self.selfdrive_state_time = mono_time['selfdriveState']
+            self.selfdrive_state = build_selfdrive_state(selfdriveState)
+
+        joy = sm['testJoystick']
+        return build_row(self.session_id, sm, sm['carState'], CC, CC.actuators, CC.hudControl, joy, joy.axes, self.live_parameters,
+                         self.car_output, controlsState, self.selfdrive_state, system_state)
+
+    def emit_row(self, row):
+        """Hand a row to the writer thread, never blocks"""
+        rows = self.rows
+        if len(rows) == RING_ROWS:
+            self.dropped_rows += 1
+        rows.append(row)
+        self.row_count += 1
 
 
 def loggerd_thread():
@@ -390,14 +516,23 @@ def loggerd_thread():
         'liveParameters',
         'controlsState',
         'selfdriveState',
-        'can'
     ], frequency=1. / DT_CTRL)
-
+    # can arrives at ~100 Hz with every CAN frame in it, but only its valid flag is logged. Sample the latest
+    # one off a conflated socket when a row is written, rather than having SubMaster parse and track them all
+    can_sock = messaging.sub_sock('can', conflate=True)
+
+    # The writer thread drops back to normal scheduling, see writer_thread(). config_realtime_process() also
+    # disables the GC, but the writer allocates a string per row for as long as loggerd runs, so turn it back on
+    config_realtime_process(LOGGERD_CORE, LOGGERD_PRIORITY)
+    gc.enable()
     rk = Ratekeeper(100, print_delay_threshold=None)
 
     loop_count = 0
     last_logging_state = False
 
+    # One system state dict for the whole run, every key but can_valid is overwritten before each log_frame call
+    system_state = {'loop_count': 0, 'system_enabled': False, 'controls_allowed': False, 'joystick_active': False, 'can_valid': False}
+
     print("loggerd: Waiting for joystick messages...")
     print("loggerd: Send loggingEnabled=True in testJoystick to start logging")
 
@@ -409,7 +544,7 @@ def loggerd_thread():
             # Check if logging should be enabled/disabled
             if sm.updated['testJoystick'] and sm.valid['testJoystick']:
                 joy = sm['testJoystick']
-                logging_requested = getattr(joy, 'loggingEnabled', False)
+                logging_requested = joy.loggingEnabled
 
                 # State change: start logging
                 if logging_requested and not last_logging_state:
@@ -423,23 +558,23 @@ def loggerd_thread():
 
             # Log data if enabled
             if logger.logging_enabled:
-                # Wait for required messages
-                if not (sm.valid['carState'] and sm.valid['carControl']):
+                # Wait for required messages, and write one row per new carState rather than per loop
+                if not (sm.updated['carState'] and sm.valid['carState'] and sm.valid['carControl']):
                     rk.keep_time()
                     continue
 
                 # Get all message data
                 CC = sm['carControl']
-                controlsState = sm['controlsState'] if sm.valid.get('controlsState', False) else None
-                selfdriveState = sm['selfdriveState'] if sm.valid.get('selfdriveState', False) else None
+                controlsState = sm['controlsState'] if sm.valid['controlsState'] else None
+                selfdriveState = sm['selfdriveState'] if sm.valid['selfdriveState'] else None
 
-                # Build system state dict
-                system_state = {
-                    'loop_count': loop_count,
-                    'system_enabled': CC.enabled if CC else False,
-                    'controls_allowed': CC.enabled if CC else False,
-                    'joystick_active': sm.valid['testJoystick'],
-                }
+                # Update system state in place
+                system_state['loop_count'] = loop_count
+                system_state['system_enabled'] = system_state['controls_allowed'] = CC.enabled if CC else False
+                system_state['joystick_active'] = sm.valid['testJoystick']
+                can = messaging.recv_one_or_none(can_sock)
+                if can is not None:
+                    system_state['can_valid'] = can.valid
 
                 # Log the frame
                 if controlsState and selfdriveState:
@@ -458,7 +593,6 @@ def loggerd_thread():
         logger.stop_logging()
     except Exception as e:
         print(f"loggerd: FATAL ERROR: {e}")
-        import traceback
         traceback.print_exc()
         logger.stop_logging()
 
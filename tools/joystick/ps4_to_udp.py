@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 """
 PS4 Controller to UDP Bridge
-Reads PS4 controller input via evdev and sends normalized values over UDP as JSON.
+Reads PS4 controller input via evdev and sends normalized values over UDP as packed binary frames.
 """
 import sys
 import os
 import argparse
 import socket
-import json
+import struct
 import time
 from evdev import InputDevice, categorize, ecodes, list_devices
 
 EXPO = 0.4
+# Binary UDP gamepad packet, keep in sync with joystick_udp.py:
+# flags (reserved, 0), left_stick_x, left_trigger, right_trigger
+UDP_FRAME = struct.Struct('<Bfff')
 
 
 def clear_screen():
@@ -187,6 +190,8 @@ def monitor_and_send(device_path, host='127.0.0.1', port=9999, show_display=True
 
     # Create UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = (host, port)
+    packet = bytearray(UDP_FRAME.size)
 
     # Initialize values
     left_stick_x = 0.0
@@ -231,16 +236,10 @@ def monitor_and_send(device_path, host='127.0.0.1', port=9999, show_display=True
                 # Rate limit sending
                 current_time = time.time()
                 if current_time - last_send_time >= send_rate:
-                    # Create JSON payload
-                    data = {
-                        'left_stick_x': round(left_stick_x, 4),
-                        'left_trigger': round(left_trigger, 4),
-                        'right_trigger': round(right_trigger, 4)
-                    }
-
                     # Send UDP packet
                     try:
-                        sock.sendto(json.dumps(data).encode('utf-8'), (host, port))
+                        UDP_FRAME.pack_into(packet, 0, 0, left_stick_x, left_trigger, right_trigger)
+                        sock.sendto(packet, target)
                     except Exception as e:
                         if show_display:
                             print(f"Send error: {e}")
@@ -269,10 +268,6 @@ def monitor_and_send(device_path, host='127.0.0.1', port=9999, show_display=True
                         print(f"Right Trigger: [{right_trig_bar}] {right_trigger:.3f}")
                         print()
 
-                        # Show JSON being sent
-                        print(f"JSON: {json.dumps(data)}")
-                        print()
-
                         # Debug info
                         print(f"Raw event - Code: {event.code} (0x{event.code:x}), Value: {event.value}")
                         print()
@@ -287,7 +282,7 @@ def monitor_and_send(device_path, host='127.0.0.1', port=9999, show_display=True
 
 def main():
     parser = argparse.ArgumentParser(
-        description='PS4 Controller to UDP Bridge - Send PS4 controller values over UDP as JSON',
+        description='PS4 Controller to UDP Bridge - Send PS4 controller values over UDP',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples: